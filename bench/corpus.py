@@ -0,0 +1,282 @@
+"""
+Generate a corpus of documents to benchmark with.
+
+Writes odt, docx, xlsx, pptx and csv documents of each size to a directory,
+named <size>.<extension>. The documents are built directly (no LibreOffice or
+other libraries needed) from random words, so they do not compress too well.
+
+    $ python3 bench/corpus.py bench/corpus
+"""
+import os
+import sys
+import random
+import zipfile
+import argparse
+
+from xml.sax.saxutils import escape
+
+
+# Approximate bytes of text per size.
+SIZES = {
+    'small': 1024 * 10,
+    'medium': 1024 * 200,
+    'large': 1024 * 2048,
+}
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+    'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+    'consequat duis aute irure in reprehenderit voluptate velit esse cillum '
+    'fugiat nulla pariatur excepteur sint occaecat cupidatat non proident '
+    'sunt culpa qui officia deserunt mollit anim id est laborum').split()
+
+ODF_OFFICE = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+ODF_TEXT = 'urn:oasis:names:tc:opendocument:xmlns:text:1.0'
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+S = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+P = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+A = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+R = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_RELS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+PKG_TYPES = 'http://schemas.openxmlformats.org/package/2006/content-types'
+OFFICE_DOCUMENT = R + '/officeDocument'
+XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+
+
+def paragraphs(rng, size, length=60):
+    """
+    Yield paragraphs of random words until about size bytes were produced.
+    """
+    total = 0
+    while total < size:
+        p = ' '.join(rng.choice(WORDS) for i in range(length)).capitalize()
+        total += len(p)
+        yield p
+
+
+def rels(*relationships):
+    return XML + '<Relationships xmlns="%s">%s</Relationships>' % (
+        PKG_RELS, ''.join(
+            '<Relationship Id="rId%i" Type="%s" Target="%s"/>' % (i + 1, t, target)
+            for i, (t, target) in enumerate(relationships)))
+
+
+def content_types(overrides):
+    return XML + (
+        '<Types xmlns="%s">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '%s</Types>') % (PKG_TYPES, ''.join(
+            '<Override PartName="%s" ContentType="%s"/>' % o for o in overrides))
+
+
+def write_odt(path, rng, size):
+    body = ''.join('<text:p>%s</text:p>' % escape(p)
+                   for p in paragraphs(rng, size))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        # The mimetype must come first, uncompressed.
+        z.writestr('mimetype', 'application/vnd.oasis.opendocument.text',
+                   zipfile.ZIP_STORED)
+        z.writestr('META-INF/manifest.xml', XML + (
+            '<manifest:manifest xmlns:manifest='
+            '"urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+            'manifest:version="1.2">'
+            '<manifest:file-entry manifest:full-path="/" manifest:media-type='
+            '"application/vnd.oasis.opendocument.text"/>'
+            '<manifest:file-entry manifest:full-path="content.xml" '
+            'manifest:media-type="text/xml"/>'
+            '</manifest:manifest>'))
+        z.writestr('content.xml', XML + (
+            '<office:document-content xmlns:office="%s" xmlns:text="%s" '
+            'office:version="1.2"><office:body><office:text>%s</office:text>'
+            '</office:body></office:document-content>') % (
+                ODF_OFFICE, ODF_TEXT, body))
+
+
+def write_docx(path, rng, size):
+    body = ''.join('<w:p><w:r><w:t>%s</w:t></w:r></w:p>' % escape(p)
+                   for p in paragraphs(rng, size))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', content_types([(
+            '/word/document.xml',
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+            'document.main+xml')]))
+        z.writestr('_rels/.rels', rels((OFFICE_DOCUMENT, 'word/document.xml')))
+        z.writestr('word/document.xml', XML + (
+            '<w:document xmlns:w="%s"><w:body>%s</w:body></w:document>') % (
+                W, body))
+
+
+def write_xlsx(path, rng, size):
+    rows = []
+    for i, p in enumerate(paragraphs(rng, size, length=8)):
+        cells = p.split(' ')
+        rows.append('<row r="%i">%s</row>' % (i + 1, ''.join(
+            '<c t="inlineStr"><is><t>%s</t></is></c>' % escape(c)
+            if n % 2 else '<c><v>%i</v></c>' % rng.randint(0, 100000)
+            for n, c in enumerate(cells))))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', content_types([
+            ('/xl/workbook.xml', 'application/vnd.openxmlformats-'
+             'officedocument.spreadsheetml.sheet.main+xml'),
+            ('/xl/worksheets/sheet1.xml', 'application/vnd.openxmlformats-'
+             'officedocument.spreadsheetml.worksheet+xml'),
+        ]))
+        z.writestr('_rels/.rels', rels((OFFICE_DOCUMENT, 'xl/workbook.xml')))
+        z.writestr('xl/_rels/workbook.xml.rels', rels(
+            (R + '/worksheet', 'worksheets/sheet1.xml')))
+        z.writestr('xl/workbook.xml', XML + (
+            '<workbook xmlns="%s" xmlns:r="%s"><sheets>'
+            '<sheet name="Sheet1" sheetId="1" r:id="rId1"/>'
+            '</sheets></workbook>') % (S, R))
+        z.writestr('xl/worksheets/sheet1.xml', XML + (
+            '<worksheet xmlns="%s"><sheetData>%s</sheetData></worksheet>') % (
+                S, ''.join(rows)))
+
+
+THEME = (
+    '<a:theme xmlns:a="%(a)s" name="Bench"><a:themeElements>'
+    '<a:clrScheme name="Bench">'
+    '<a:dk1><a:srgbClr val="000000"/></a:dk1>'
+    '<a:lt1><a:srgbClr val="FFFFFF"/></a:lt1>'
+    '<a:dk2><a:srgbClr val="1F497D"/></a:dk2>'
+    '<a:lt2><a:srgbClr val="EEECE1"/></a:lt2>'
+    '<a:accent1><a:srgbClr val="4F81BD"/></a:accent1>'
+    '<a:accent2><a:srgbClr val="C0504D"/></a:accent2>'
+    '<a:accent3><a:srgbClr val="9BBB59"/></a:accent3>'
+    '<a:accent4><a:srgbClr val="8064A2"/></a:accent4>'
+    '<a:accent5><a:srgbClr val="4BACC6"/></a:accent5>'
+    '<a:accent6><a:srgbClr val="F79646"/></a:accent6>'
+    '<a:hlink><a:srgbClr val="0000FF"/></a:hlink>'
+    '<a:folHlink><a:srgbClr val="800080"/></a:folHlink>'
+    '</a:clrScheme>'
+    '<a:fontScheme name="Bench">'
+    '<a:majorFont><a:latin typeface="Liberation Sans"/><a:ea typeface=""/>'
+    '<a:cs typeface=""/></a:majorFont>'
+    '<a:minorFont><a:latin typeface="Liberation Sans"/><a:ea typeface=""/>'
+    '<a:cs typeface=""/></a:minorFont>'
+    '</a:fontScheme>'
+    '<a:fmtScheme name="Bench">'
+    '<a:fillStyleLst>%(fill)s%(fill)s%(fill)s</a:fillStyleLst>'
+    '<a:lnStyleLst>%(line)s%(line)s%(line)s</a:lnStyleLst>'
+    '<a:effectStyleLst>%(effect)s%(effect)s%(effect)s</a:effectStyleLst>'
+    '<a:bgFillStyleLst>%(fill)s%(fill)s%(fill)s</a:bgFillStyleLst>'
+    '</a:fmtScheme></a:themeElements></a:theme>') % {
+        'a': A,
+        'fill': '<a:solidFill><a:schemeClr val="phClr"/></a:solidFill>',
+        'line': '<a:ln w="9525"><a:solidFill><a:schemeClr val="phClr"/>'
+                '</a:solidFill></a:ln>',
+        'effect': '<a:effectStyle><a:effectLst/></a:effectStyle>',
+    }
+SHAPE_TREE = (
+    '<p:cSld><p:spTree><p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/>'
+    '<p:nvPr/></p:nvGrpSpPr><p:grpSpPr/>%s</p:spTree></p:cSld>')
+TEXT_BOX = (
+    '<p:sp><p:nvSpPr><p:cNvPr id="2" name="Text"/><p:cNvSpPr txBox="1"/>'
+    '<p:nvPr/></p:nvSpPr><p:spPr><a:xfrm><a:off x="457200" y="457200"/>'
+    '<a:ext cx="8229600" cy="5943600"/></a:xfrm>'
+    '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></p:spPr>'
+    '<p:txBody><a:bodyPr/><a:lstStyle/>%s</p:txBody></p:sp>')
+
+
+def write_pptx(path, rng, size):
+    # About 6 paragraphs per slide.
+    texts = list(paragraphs(rng, size, length=20))
+    slides = [texts[i:i + 6] for i in range(0, len(texts), 6)]
+    ns = 'xmlns:a="%s" xmlns:r="%s" xmlns:p="%s"' % (A, R, P)
+    pml = 'application/vnd.openxmlformats-officedocument.presentationml.'
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', content_types([
+            ('/ppt/presentation.xml', pml + 'presentation.main+xml'),
+            ('/ppt/slideMasters/slideMaster1.xml', pml + 'slideMaster+xml'),
+            ('/ppt/slideLayouts/slideLayout1.xml', pml + 'slideLayout+xml'),
+            ('/ppt/theme/theme1.xml',
+             'application/vnd.openxmlformats-officedocument.theme+xml'),
+        ] + [
+            ('/ppt/slides/slide%i.xml' % (i + 1), pml + 'slide+xml')
+            for i in range(len(slides))
+        ]))
+        z.writestr('_rels/.rels', rels((OFFICE_DOCUMENT, 'ppt/presentation.xml')))
+        z.writestr('ppt/_rels/presentation.xml.rels', rels(
+            (R + '/slideMaster', 'slideMasters/slideMaster1.xml'),
+            (R + '/theme', 'theme/theme1.xml'),
+            *[(R + '/slide', 'slides/slide%i.xml' % (i + 1))
+              for i in range(len(slides))]))
+        z.writestr('ppt/presentation.xml', XML + (
+            '<p:presentation %s><p:sldMasterIdLst>'
+            '<p:sldMasterId id="2147483648" r:id="rId1"/></p:sldMasterIdLst>'
+            '<p:sldIdLst>%s</p:sldIdLst>'
+            '<p:sldSz cx="9144000" cy="6858000"/>'
+            '<p:notesSz cx="6858000" cy="9144000"/></p:presentation>') % (
+                ns, ''.join('<p:sldId id="%i" r:id="rId%i"/>' % (256 + i, i + 3)
+                            for i in range(len(slides)))))
+        z.writestr('ppt/theme/theme1.xml', XML + THEME)
+        z.writestr('ppt/slideMasters/_rels/slideMaster1.xml.rels', rels(
+            (R + '/slideLayout', '../slideLayouts/slideLayout1.xml'),
+            (R + '/theme', '../theme/theme1.xml')))
+        z.writestr('ppt/slideMasters/slideMaster1.xml', XML + (
+            '<p:sldMaster %s>%s<p:clrMap bg1="lt1" tx1="dk1" bg2="lt2" '
+            'tx2="dk2" accent1="accent1" accent2="accent2" accent3="accent3" '
+            'accent4="accent4" accent5="accent5" accent6="accent6" '
+            'hlink="hlink" folHlink="folHlink"/><p:sldLayoutIdLst>'
+            '<p:sldLayoutId id="2147483649" r:id="rId1"/></p:sldLayoutIdLst>'
+            '</p:sldMaster>') % (ns, SHAPE_TREE % ''))
+        z.writestr('ppt/slideLayouts/_rels/slideLayout1.xml.rels', rels(
+            (R + '/slideMaster', '../slideMasters/slideMaster1.xml')))
+        z.writestr('ppt/slideLayouts/slideLayout1.xml', XML + (
+            '<p:sldLayout %s type="blank">%s<p:clrMapOvr>'
+            '<a:masterClrMapping/></p:clrMapOvr></p:sldLayout>') % (
+                ns, SHAPE_TREE % ''))
+
+        for i, slide in enumerate(slides):
+            z.writestr('ppt/slides/_rels/slide%i.xml.rels' % (i + 1), rels(
+                (R + '/slideLayout', '../slideLayouts/slideLayout1.xml')))
+            body = ''.join('<a:p><a:r><a:t>%s</a:t></a:r></a:p>' % escape(p)
+                           for p in slide)
+            z.writestr('ppt/slides/slide%i.xml' % (i + 1), XML + (
+                '<p:sld %s>%s<p:clrMapOvr><a:masterClrMapping/></p:clrMapOvr>'
+                '</p:sld>') % (ns, SHAPE_TREE % (TEXT_BOX % body)))
+
+
+def write_csv(path, rng, size):
+    with open(path, 'w') as f:
+        f.write('id,name,description,amount\n')
+        for i, p in enumerate(paragraphs(rng, size, length=12)):
+            words = p.split(' ')
+            f.write('%i,%s,"%s",%i\n' % (
+                i, words[0], ' '.join(words[1:]), rng.randint(0, 100000)))
+
+
+WRITERS = {
+    'odt': write_odt,
+    'docx': write_docx,
+    'xlsx': write_xlsx,
+    'pptx': write_pptx,
+    'csv': write_csv,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('path', help='Directory to write the corpus to.')
+    parser.add_argument('--sizes', default=','.join(SIZES),
+                        help='Comma separated sizes (default: %(default)s).')
+    parser.add_argument('--types', default=','.join(WRITERS),
+                        help='Comma separated types (default: %(default)s).')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.path, exist_ok=True)
+    for size in args.sizes.split(','):
+        for extension in args.types.split(','):
+            # The same seed per document, so a corpus can be regenerated.
+            rng = random.Random('%s-%s-%s' % (args.seed, size, extension))
+            path = os.path.join(args.path, '%s.%s' % (size, extension))
+            WRITERS[extension](path, rng, SIZES[size])
+            print('%s: %i bytes' % (path, os.path.getsize(path)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Drive officer with concurrent conversions and report latency.
+
+For each mode and concurrency level, sends --requests conversions of each
+document in the corpus, with that many in flight at once, and reports
+throughput and latency percentiles.
+
+Modes:
+    pdf   POST documents to /pdf/.
+    png   POST documents to /png/.
+    url   GET /pdf/?url=..., the corpus is served by this script at --serve.
+
+    $ python3 bench/load.py bench/corpus --modes pdf,url --concurrency 1,4,16
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import mimetypes
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+
+# Content types mimetypes may not know.
+CONTENT_TYPES = {
+    '.odt': 'application/vnd.oasis.opendocument.text',
+    '.docx': 'application/vnd.openxmlformats-officedocument.'
+             'wordprocessingml.document',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.'
+             'spreadsheetml.sheet',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.'
+             'presentationml.presentation',
+    '.csv': 'text/csv',
+}
+
+
+def percentile(values, p):
+    """
+    The pth percentile of sorted values (nearest rank).
+    """
+    if not values:
+        return float('nan')
+    rank = max(0, int(round(p / 100 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def corpus(path):
+    documents = []
+    for name in sorted(os.listdir(path)):
+        extension = os.path.splitext(name)[1]
+        content_type = CONTENT_TYPES.get(extension) or \
+            mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        with open(os.path.join(path, name), 'rb') as f:
+            documents.append((name, content_type, f.read()))
+    return documents
+
+
+async def serve(path, address):
+    '''
+    Serve the corpus to officer for url mode.
+    '''
+    host, port = address.rsplit(':', 1)
+    app = web.Application()
+    app.add_routes([web.static('/', path)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, int(port)).start()
+    return runner
+
+
+def request(session, args, mode, document):
+    name, content_type, data = document
+
+    if mode == 'url':
+        return session.get('%s/pdf/' % args.url, params={
+            'url': 'http://%s/%s' % (args.serve, name),
+        })
+
+    return session.post('%s/%s/' % (args.url, mode), data=data,
+                        headers={'Content-Type': content_type})
+
+
+async def run(session, args, mode, concurrency, documents):
+    work = [d for d in documents for i in range(args.requests)]
+    latencies, errors, received = [], {}, 0
+
+    async def worker():
+        nonlocal received
+        while work:
+            document = work.pop()
+            start = time.monotonic()
+            try:
+                async with request(session, args, mode, document) as r:
+                    body = await r.read()
+
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+
+            if r.status != 200:
+                errors[r.status] = errors.get(r.status, 0) + 1
+                continue
+
+            latencies.append(time.monotonic() - start)
+            received += len(body)
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': {str(k): v for k, v in errors.items()},
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'bytes_per_second': received / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def report(result):
+    print('%-4s %5i %8i %6i %9.2f %9.1f %8.3f %8.3f %8.3f' % (
+        result['mode'], result['concurrency'], result['requests'],
+        sum(result['errors'].values()), result['throughput'],
+        result['bytes_per_second'] / 1024, result['p50'], result['p95'],
+        result['p99']))
+
+
+async def main(args):
+    documents = corpus(args.corpus)
+    modes = args.modes.split(',')
+    runner = await serve(args.corpus, args.serve) if 'url' in modes else None
+    results = []
+
+    print('%-4s %5s %8s %6s %9s %9s %8s %8s %8s' % (
+        'mode', 'conc', 'requests', 'errors', 'req/s', 'KiB/s', 'p50', 'p95',
+        'p99'))
+    try:
+        async with ClientSession(
+                timeout=ClientTimeout(total=args.timeout)) as session:
+            for mode in modes:
+                for concurrency in map(int, args.concurrency.split(',')):
+                    result = await run(session, args, mode, concurrency,
+                                       documents)
+                    report(result)
+                    results.append(result)
+
+    finally:
+        if runner:
+            await runner.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('corpus', help='Directory of documents to convert.')
+    parser.add_argument('--url', default='http://localhost:8080',
+                        help='officer (default: %(default)s).')
+    parser.add_argument('--modes', default='pdf,png,url',
+                        help='Comma separated modes (default: %(default)s).')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Comma separated levels (default: %(default)s).')
+    parser.add_argument('--requests', type=int, default=5,
+                        help='Requests per document per level '
+                             '(default: %(default)s).')
+    parser.add_argument('--serve', default='127.0.0.1:8081',
+                        help='Address to serve the corpus at in url mode, '
+                             'reachable by officer (default: %(default)s).')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', help='Also write results to this file.')
+    sys.exit(asyncio.get_event_loop().run_until_complete(
+        main(parser.parse_args())))
@@ -0,0 +1,125 @@
+"""
+Measure the UNO bridge to soffice over each transport.
+
+Starts a soffice instance per transport and reports the round trip latency of
+a trivial call, and the throughput of moving bytes through a pipe object in
+soffice (writeBytes then readBytes, as a conversion streams it's input and
+output) for several chunk sizes. Needs soffice and pyuno.
+
+    $ python3 bench/transport.py --calls 10000 --megabytes 256
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+
+from tempfile import mkdtemp
+
+import uno
+from com.sun.star.connection import NoConnectException
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rest'))
+
+from soffice import SOffice  # noqa: E402
+
+
+# Far from the indexes of a running officer.
+INDEX = 900
+
+
+def connect(address, timeout=60):
+    context = uno.getComponentContext()
+    resolver = context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.bridge.UnoUrlResolver", context)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            return resolver.resolve('uno:%s' % address)
+
+        except NoConnectException:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+
+def round_trips(ctx, calls):
+    desktop = ctx.ServiceManager.createInstanceWithContext(
+        "com.sun.star.frame.Desktop", ctx)
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        desktop.getFrames()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies
+
+
+def bulk(ctx, chunk, total):
+    pipe = ctx.ServiceManager.createInstanceWithContext(
+        "com.sun.star.io.Pipe", ctx)
+    data = uno.ByteSequence(os.urandom(chunk))
+    moved = 0
+
+    start = time.perf_counter()
+    while moved < total:
+        pipe.writeBytes(data)
+        count, _ = pipe.readBytes(None, chunk)
+        moved += count
+    elapsed = time.perf_counter() - start
+
+    pipe.closeOutput()
+    pipe.closeInput()
+    return moved / elapsed
+
+
+def measure(transport, args):
+    address = SOffice.address_for(INDEX, transport)
+    install_dir = mkdtemp(prefix='soffice-bench-')
+    p = subprocess.Popen(SOffice.command_for(address, install_dir),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        ctx = connect(address)
+        # Let soffice settle after starting.
+        round_trips(ctx, 100)
+
+        latencies = round_trips(ctx, args.calls)
+        print('%-6s round trip  p50 %7.1fus  p99 %7.1fus  mean %7.1fus' % (
+            transport,
+            latencies[len(latencies) // 2] * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6,
+            sum(latencies) / len(latencies) * 1e6))
+
+        for chunk in map(int, args.chunks.split(',')):
+            throughput = bulk(ctx, chunk, args.megabytes * 1024 ** 2)
+            print('%-6s bulk %8i byte chunks  %8.1f MiB/s' % (
+                transport, chunk, throughput / 1024 ** 2))
+
+    finally:
+        p.kill()
+        p.wait()
+        shutil.rmtree(install_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--transports', default=','.join(SOffice.TRANSPORTS),
+                        help='Comma separated transports (default: %(default)s).')
+    parser.add_argument('--calls', type=int, default=5000,
+                        help='Round trips to time (default: %(default)s).')
+    parser.add_argument('--chunks', default='4096,16384,65536,1048576',
+                        help='Comma separated chunk sizes in bytes '
+                             '(default: %(default)s).')
+    parser.add_argument('--megabytes', type=int, default=128,
+                        help='MiB to move per chunk size (default: %(default)s).')
+    args = parser.parse_args(argv)
+
+    for transport in args.transports.split(','):
+        measure(transport, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
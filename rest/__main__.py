@@ -1,6 +1,7 @@
 import os
 import json
 import asyncio
+import hashlib
 import logging
 import mimetypes
 import aiofiles
@@ -9,136 +10,369 @@ import os.path
 
 from functools import partial
 from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 from aiohttp import web
 
-from convert import convert
+import metrics
+import workers
+
+from batch import batch_handler
+from jobs import cleanup, status_handler, submit_handler
+from cache import ResultCache, make_key
+from coalesce import coalesce
+from health import live, prober, ready
+from convert import (
+    POOL, SCHEDULER, convert, convert_many, convert_sharded, rasterize,
+)
 from config import (
-    MAX_CHUNK, MAX_MEMORY, TEMP_DIR, MAX_CONCURRENCY,
+    MAX_CHUNK, MAX_MEMORY, TEMP_DIR, MAX_CONCURRENCY, CACHE_MEMORY, CACHE_DISK,
+    WORKER, WORKERS,
+)
+from responses import (
+    CONTENT_TYPES, make_response, multipart_response, multipart_stream_response,
+    zip_response,
+)
+from params import (
+    get_client, get_export, get_image, get_merge, get_pages, get_priority,
+    get_raster, get_shards, get_stream, get_targets, get_timeout,
 )
-from spooled import NamedSpooledTemporaryFile
+from scheduler import INTERACTIVE, JobTimeout, QueueFull
+from shards import Merger
+from spooled import NamedSpooledTemporaryFile, copyfileobj
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.StreamHandler())
 logging.getLogger().setLevel(logging.DEBUG)
 
+# Each worker process has a cache of it's own.
+CACHE_DIR = 'officer-cache-%s' % WORKER if WORKER else 'officer-cache'
+CACHE = ResultCache(
+    os.path.join(TEMP_DIR, CACHE_DIR), CACHE_MEMORY, CACHE_DISK)
 
-async def copyfileobj(src, dst, length=None):
-    size = 0
-    while True:
-        chunk = await src.read(length)
-        if not chunk:
-            break
-        size += len(chunk)
-        await dst.write(chunk)
-    await dst.flush()
-    return size
+metrics.Gauge(
+    'officer_cache', 'Result cache counters and usage.', ('stat',),
+    fn=lambda: {(k,): v for k, v in CACHE.stats().items()})
 
 
-async def download(url, **kwargs):
-    async with aiohttp.ClientSession(**kwargs) as s:
-        async with s.get(url) as r:
-            extension = mimetypes.guess_extension(r.headers['content-type'])
-            temp = NamedSpooledTemporaryFile(
-                max_size=MAX_MEMORY, mode='wb+', dir=TEMP_DIR, suffix=extension)
+async def download(session, url, headers=None, cookies=None):
+    '''
+    Spool a remote document, returns the file, it's content type, size and
+    validators (ETag and Last-Modified), or None if the request was
+    conditional and the document is not modified.
 
-            size = await copyfileobj(request.content, temp, length=MAX_CHUNK)
-            return temp, size
+    The type and size come from the GET response, so no separate HEAD request
+    is needed.
+    '''
+    async with session.get(url, headers=headers, cookies=cookies) as r:
+        if r.status == 304:
+            return None
 
+        r.raise_for_status()
+        content_type = r.content_type
+        validators = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        extension = mimetypes.guess_extension(content_type)
+        temp = await NamedSpooledTemporaryFile(
+            max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR, suffix=extension)
 
-async def head(url):
-    async with aiohttp.ClientSession() as s:
-        async with s.head(url) as r:
-            content_type = r.headers['content-type']
-            size = int(r.headers['content-length'])
-            return content_type.split(';')[0], size
+        try:
+            size = await copyfileobj(r.content, temp, length=MAX_CHUNK)
 
+        except BaseException:
+            await temp.close()
+            raise
 
-def get_pages(request):
-    pages = request.query.get('pages')
+        LOGGER.info('Downloaded %s: %i bytes', url, size)
+        return temp, content_type, size, validators
 
-    if pages:
-        try:
-            pages = tuple(map(int, pages.split('-')))
 
-        except ValueError:
-            raise web.HTTPBadRequest(reason='Invalid param pages')
+async def fetch(request, url, validators=None):
+    '''
+    Download url with the headers and cookies given in the querystring.
 
-        if len(pages) != 2:
-            raise web.HTTPBadRequest(reason='Param pages must be in form: 1-?')
+    Remote documents are always fetched by us, soffice's own fetcher is slow
+    and does not support headers or cookies.
+    '''
+    headers = json.loads(request.query.get('headers') or 'null')
+    cookies = json.loads(request.query.get('cookies') or 'null')
+
+    if validators:
+        etag, last_modified = validators
+        headers = dict(headers or {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
-    return pages
+    try:
+        return await download(request.app['client'], url, headers=headers,
+                              cookies=cookies)
 
+    except aiohttp.ClientError as e:
+        LOGGER.warning('Fetching %s failed: %s', url, e)
+        raise web.HTTPBadGateway(reason='Fetching URL Failed')
 
-class TempfileResponse(web.FileResponse):
+
+async def spool(request, extension, hasher=None):
+    '''
+    Read the body of request into a temporary file, returns it and its size.
     '''
-    A FileResponse subclass that cleans up the file after the response.
+    temp = await NamedSpooledTemporaryFile(
+        max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR, suffix=extension)
+
+    try:
+        size = await copyfileobj(request.content, temp, length=MAX_CHUNK,
+                                 hasher=hasher)
+
+    except BaseException:
+        await temp.close()
+        raise
+
+    LOGGER.debug('Body content_type: %s', request.content_type)
+    LOGGER.info('Body read: %i bytes', size)
+    return temp, size
+
+
+async def client_session(app):
+    '''
+    A ClientSession shared by all requests, so connections to remote hosts are
+    pooled and kept alive.
+
+    Cookies set by remote hosts are not kept, those passed with a request are
+    sent with that request only.
+    '''
+    async with aiohttp.ClientSession(
+            cookie_jar=aiohttp.DummyCookieJar()) as session:
+        app['client'] = session
+        yield
+
+
+async def stream_response(request, output, format, key=None):
     '''
-    async def prepare(self, *args, **kwargs):
+    Send output to the client with chunked encoding as soffice writes it.
+
+    If key is given and the output fits in the memory cache, it is collected
+    and cached once complete.
+    '''
+    response = web.StreamResponse()
+    response.content_type = CONTENT_TYPES[format]
+    response.enable_chunked_encoding()
+    chunks, cached = [], 0
+
+    try:
+        # Wait for the first chunk, failures loading the document can then
+        # still be reported with a proper status.
+        chunk = await output.read()
+        await response.prepare(request)
+
         try:
-            return await super(TempfileResponse, self).prepare(
-                *args, **kwargs)
+            while chunk:
+                if key and cached <= CACHE.max_memory:
+                    chunks.append(chunk)
+                    cached += len(chunk)
+                await response.write(chunk)
+                chunk = await output.read()
 
-        finally:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, partial(os.unlink, self._path))
+        except Exception as e:
+            # Headers are sent, all we can do is abort so the client does not
+            # mistake a truncated body for a complete one.
+            LOGGER.exception(e)
+            request.transport.close()
+            return response
+
+        await response.write_eof()
 
+    finally:
+        output.cancel()
+        # If the client went away before the conversion ran, the scheduler
+        # drops the job rather than run it against a closed input.
+        output.future.cancel()
 
-def make_response(pdf):
-    if isinstance(pdf, BytesIO):
-        response = web.Response(body=pdf.getvalue())
-    
-    else:
-        response = TempfileResponse(path=pdf.name)
+    if key and cached <= CACHE.max_memory:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, partial(CACHE.put, key, BytesIO(b''.join(chunks))))
 
-    response.content_type = 'application/pdf'
     return response
 
 
+async def raster_response(request, outputs):
+    '''
+    Respond with rendered pages as a multipart/mixed body, or a zip archive
+    when archive=zip is given.
+    '''
+    if not outputs:
+        raise web.HTTPBadRequest(reason='No such pages')
+
+    items = [
+        ('page-%i.png' % page, 'png', output) for page, output in outputs
+    ]
+
+    if request.query.get('archive') == 'zip':
+        return await zip_response(items)
+
+    return multipart_response(items)
+
+
+async def shards_response(request, shards):
+    '''
+    Respond with the PDF of a sharded conversion.
+
+    The shards are merged, each appended as soon as it and those before it
+    finished. When merge=0 is given, the PDF of each shard is sent in order as
+    a part of a multipart/mixed body as soon as it finished.
+    '''
+    loop = asyncio.get_running_loop()
+
+    try:
+        if get_merge(request):
+            merger = Merger()
+            try:
+                async for pages, output in shards:
+                    await loop.run_in_executor(None, merger.append, output)
+
+            except BaseException:
+                merger.close()
+                raise
+
+            return make_response(await loop.run_in_executor(None, merger.write))
+
+        async def items():
+            async for pages, output in shards:
+                name = 'pages-%i-%i.pdf' % pages if pages else 'document.pdf'
+                yield name, 'pdf', output
+
+        return await multipart_stream_response(request, items())
+
+    finally:
+        await shards.aclose()
+
+
 def make_get_handler(format):
+    async def convert_url(request, key):
+        '''
+        Convert a remote document, or revalidate a cached result of it's
+        conversion with the origin.
+        '''
+        url, pages = request.query.get('url'), get_pages(request)
+        image = get_image(request) if format == 'png' else None
+        export = get_export(request) if format == 'pdf' else None
+        loop = asyncio.get_running_loop()
+        validators, cached = CACHE.validators(key), None
+        if validators:
+            cached = await loop.run_in_executor(None, partial(CACHE.get, key))
+
+        with admit(request) as job:
+            await SCHEDULER.fetch(job)
+            try:
+                result = await fetch(
+                    request, url, validators if cached else None)
+
+            except BaseException:
+                if cached:
+                    cached.close()
+                raise
+
+            if result is None:
+                LOGGER.debug('Not modified: %s', url)
+                return cached
+
+            if cached:
+                cached.close()
+
+            temp, content_type, size, validators = result
+            try:
+                pdf = await convert(format, file=temp, content_type=content_type,
+                                    pages=pages, size=size, image=image,
+                                    export=export, job=job)
+
+            except JobTimeout as e:
+                LOGGER.warning('Conversion timed out: %s', e)
+                raise web.HTTPGatewayTimeout(reason='Conversion Timed Out')
+
+            except Exception as e:
+                LOGGER.exception(e)
+                raise web.HTTPInternalServerError(reason='Internal Server Error')
+
+            finally:
+                await temp.close()
+
+        if CACHE.enabled and any(validators):
+            await loop.run_in_executor(
+                None, partial(CACHE.put, key, pdf, validators))
+
+        return pdf
+
     async def handler(request):
-        url, headers, cookies = request.query.get('url'), None, None
-        kwargs = {}
-
-        if url.startswith('http'):
-            # This is a remote URL, could be additional options provided.
-            headers = request.query.get('headers')
-            cookies = request.query.get('cookies')
-
-        else:
-            # This is a local URL, try to guess the content_type.
-            kwargs['url'], (kwargs['content_type'], _) = \
-                url, mimetypes.guess_type(url)
-            kwargs['size'] = os.path.getsize(url)
-
-        if headers or cookies:
-            # We have to do the fetch, soffice does not support headers or other
-            # advanced options.
-            headers = json.loads(headers)
-            cookies = json.loads(cookies)
-
-            kwargs['file'], kwargs['content_type'], kwargs['size'] = \
-                await download(url, headers=headers, cookies=cookies)
-
-        else:
-            # We will let soffice do the request. We omit content_type here, as
-            # soffice can use the Content-Type header it receives.
-            kwargs['url'] = url
-            kwargs['content_type'], kwargs['size'] = await head(url)
+        url = request.query.get('url')
+        pages = get_pages(request)
+        image = get_image(request) if format == 'png' else None
+        export = get_export(request) if format == 'pdf' else None
+        # Several pages as PNG are rendered from one load, as in a POST.
+        raster = get_raster(format, pages)
+
+        if url.startswith('http') and not (get_stream(request) or raster):
+            # Identical requests for a remote document share one conversion.
+            key = make_key(url, format, pages,
+                           headers=request.query.get('headers'),
+                           cookies=request.query.get('cookies'),
+                           **(image or {}), **(export or {}))
+            pdf = await coalesce(key, partial(convert_url, request, key))
+            return make_response(pdf, format)
+
+        with admit(request) as job:
+            await SCHEDULER.fetch(job)
+            temp = None
+            kwargs = {'image': image}
+
+            if url.startswith('http'):
+                temp, kwargs['content_type'], kwargs['size'], _ = \
+                    await fetch(request, url)
+                kwargs['file'] = temp
+
+            else:
+                # This is a local file, soffice reads it directly, try to
+                # guess the content_type.
+                if url.startswith('file:'):
+                    path = url2pathname(urlparse(url).path)
+
+                else:
+                    path, url = url, Path(os.path.abspath(url)).as_uri()
+
+                kwargs['url'] = url
+                kwargs['content_type'], _ = mimetypes.guess_type(path)
+                kwargs['size'] = os.path.getsize(path)
 
-        try:
-            pdf = await convert(format, **kwargs)
+            try:
+                if raster:
+                    outputs = await rasterize(pages, job=job, **kwargs)
+                    return await raster_response(request, outputs)
 
-        except Exception as e:
-            LOGGER.exception(e)
-            raise web.HTTPInternalServerError(reason='Internal Server Error')
+                if get_stream(request):
+                    output = await convert(format, stream=True, pages=pages,
+                                           export=export, job=job, **kwargs)
+                    return await stream_response(request, output, format)
 
-        finally:
-            f = kwargs.get('file')
-            if hasattr(f, '_file') and getattr(f._file, '_rolled', None) is True:
-                f = f._file._file
-                os.unlink(f.name)
+                pdf = await convert(format, pages=pages, export=export,
+                                    job=job, **kwargs)
+
+            except web.HTTPException:
+                raise
 
-        return make_response(pdf)
+            except JobTimeout as e:
+                LOGGER.warning('Conversion timed out: %s', e)
+                raise web.HTTPGatewayTimeout(reason='Conversion Timed Out')
+
+            except Exception as e:
+                LOGGER.exception(e)
+                raise web.HTTPInternalServerError(reason='Internal Server Error')
+
+            finally:
+                if temp:
+                    await temp.close()
+
+            return make_response(pdf, format)
 
     return handler
 
@@ -149,6 +383,92 @@ def make_post_handler(format):
         pages = get_pages(request)
         extension = mimetypes.guess_extension(content_type)
 
+        stream = get_stream(request)
+        image = get_image(request) if format == 'png' else None
+        export = get_export(request) if format == 'pdf' else None
+        # Several pages as PNG are rendered from one load and returned as a
+        # multipart body or zip.
+        raster = get_raster(format, pages)
+        # Large documents can be exported as PDF on several instances at once.
+        shards = get_shards(request) if format == 'pdf' else None
+        hasher = hashlib.sha256() \
+            if CACHE.enabled and not (raster or shards) else None
+        key = None
+        temp = None
+        loop = asyncio.get_running_loop()
+
+        try:
+            with admit(request) as job:
+                await SCHEDULER.fetch(job)
+                temp, size = await spool(request, extension, hasher)
+
+                if hasher:
+                    key = make_key(hasher.hexdigest(), format, pages,
+                                   content_type=content_type, **(image or {}),
+                                   **(export or {}))
+                    pdf = await loop.run_in_executor(None, partial(CACHE.get, key))
+                    if pdf is not None:
+                        # A hit needs no instance, it gives up it's place in
+                        # the queue and lookahead slot straight away.
+                        LOGGER.debug('Cache hit: %s', key)
+                        job.close()
+                        return make_response(pdf, format)
+
+                try:
+                    if raster:
+                        outputs = await rasterize(
+                            pages, file=temp, content_type=content_type,
+                            size=size, image=image, job=job)
+                        return await raster_response(request, outputs)
+
+                    if shards:
+                        return await shards_response(request, convert_sharded(
+                            shards, pages=pages, file=temp,
+                            content_type=content_type, size=size,
+                            export=export, job=job))
+
+                    if stream:
+                        output = await convert(
+                            format, file=temp, content_type=content_type,
+                            pages=pages, size=size, image=image, export=export,
+                            stream=True, job=job)
+                        return await stream_response(request, output, format, key)
+
+                    pdf = await convert(format, file=temp, content_type=content_type,
+                                        pages=pages, size=size, image=image,
+                                        export=export, job=job)
+
+                except web.HTTPException:
+                    raise
+
+                except JobTimeout as e:
+                    LOGGER.warning('Conversion timed out: %s', e)
+                    raise web.HTTPGatewayTimeout(reason='Conversion Timed Out')
+
+                except Exception as e:
+                    LOGGER.exception(e)
+                    raise web.HTTPInternalServerError(reason='Internal Server Error')
+
+            if key:
+                await loop.run_in_executor(None, partial(CACHE.put, key, pdf))
+
+            return make_response(pdf, format)
+
+        finally:
+            if temp is not None:
+                await temp.close()
+
+    return handler
+
+
+async def convert_handler(request):
+    content_type = request.content_type
+    targets = get_targets(request)
+    archive = request.query.get('archive')
+    extension = mimetypes.guess_extension(content_type)
+
+    with admit(request) as job:
+        await SCHEDULER.fetch(job)
         async with NamedSpooledTemporaryFile(
             max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR,
             suffix=extension) as temp:
@@ -156,43 +476,85 @@ def make_post_handler(format):
             size = await copyfileobj(request.content, temp, length=MAX_CHUNK)
 
             LOGGER.debug('Body content_type: %s', content_type)
-            LOGGER.info('Body read: %i bytes', await temp.tell())
+            LOGGER.info('Body read: %i bytes', size)
 
             try:
-                pdf = await convert(format, file=temp, content_type=content_type,
-                                    pages=pages, size=size)
+                outputs = await convert_many(
+                    targets, file=temp, content_type=content_type, size=size,
+                    job=job)
+
+            except JobTimeout as e:
+                LOGGER.warning('Conversion timed out: %s', e)
+                raise web.HTTPGatewayTimeout(reason='Conversion Timed Out')
 
             except Exception as e:
                 LOGGER.exception(e)
                 raise web.HTTPInternalServerError(reason='Internal Server Error')
 
-            return make_response(pdf)
+    items = [
+        ('output-%i.%s' % (i, format), format, output)
+        for i, ((format, pages), output) in enumerate(zip(targets, outputs))
+    ]
+
+    if archive == 'zip':
+        return await zip_response(items)
+
+    return multipart_response(items)
 
-    return handler
 
-async def health(request):
+def admit(request, priority=INTERACTIVE):
+    return SCHEDULER.admit(get_priority(request, priority), get_client(request),
+                           timeout=get_timeout(request))
+
+
+@web.middleware
+async def admission_control(request, handler):
     try:
-        pdf = await convert(data=b'Health check', content_type='text/plain')
+        return await handler(request)
+
+    except QueueFull as e:
+        raise web.HTTPTooManyRequests(
+            reason='Queue full', headers={'Retry-After': '%i' % e.retry_after})
 
-    except Exception as e:
-        LOGGER.exception(e)
-        return web.Response(text='ERROR', status=503)
 
-    else:
-        return web.Response(text='OK')
+async def cache_stats(request):
+    return web.json_response(CACHE.stats())
 
 
-LOGGER.debug('MAX_CONCURRENCY: %i', MAX_MEMORY)
+async def metrics_handler(request):
+    # With WORKERS > 1 some metrics are asked from the registry.
+    loop = asyncio.get_running_loop()
+    text = await loop.run_in_executor(None, metrics.render)
+    return web.Response(
+        body=text.encode('utf8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+LOGGER.debug('MAX_CONCURRENCY: %i', MAX_CONCURRENCY)
 LOGGER.debug('MAX_MEMORY: %i', MAX_MEMORY)
-LOGGER.debug('MAX_CHUNK: %i', MAX_MEMORY)
-LOGGER.debug('TEMP_DIR: %i', MAX_MEMORY)
+LOGGER.debug('MAX_CHUNK: %i', MAX_CHUNK)
+LOGGER.debug('TEMP_DIR: %s', TEMP_DIR)
 
-app = web.Application()
+app = web.Application(middlewares=[admission_control])
+app.cleanup_ctx.extend([client_session, cleanup, prober])
 app.add_routes([
-    web.get('/', health),
+    web.get('/', ready),
+    web.get('/live', live),
+    web.get('/ready', ready),
+    web.get('/cache/', cache_stats),
+    web.get('/metrics', metrics_handler),
+    web.post('/convert/', convert_handler),
+    web.post('/batch/', batch_handler),
+    web.post('/jobs/', submit_handler),
+    web.get('/jobs/{id}', status_handler),
     web.get('/pdf/', make_get_handler('pdf')),
     web.post('/pdf/', make_post_handler('pdf')),
     web.get('/png/', make_get_handler('png')),
     web.post('/png/', make_post_handler('png')),
 ])
-web.run_app(app)
+if WORKERS > 1 and WORKER is None:
+    # This process runs soffice, the workers serve HTTP.
+    workers.run(POOL)
+
+else:
+    web.run_app(app, reuse_port=WORKER is not None)
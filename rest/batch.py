@@ -0,0 +1,438 @@
+import re
+import json
+import uuid
+import asyncio
+import logging
+import mimetypes
+import zipfile
+
+from functools import partial
+from urllib.parse import quote
+from aiohttp import web
+
+from convert import SCHEDULER, convert
+from config import MAX_CHUNK, MAX_MEMORY, TEMP_DIR, BATCH_WINDOW
+from params import get_client, get_priority, get_timeout, parse_pages
+from responses import CONTENT_TYPES
+from scheduler import BULK
+from spooled import NamedSpooledTemporaryFile, copyfileobj
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Never passed on in names, they could end a header of the response.
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1f\x7f]')
+
+
+class BatchItem(object):
+    """
+    A single document of a batch and the outcome of it's conversion.
+
+    An item that failed has error set and status is the HTTP status it is
+    reported with, 400 if it's options were invalid, 500 if converting it
+    failed.
+    """
+    def __init__(self, name, content_type, format=None, pages=None):
+        self.name = name
+        self.content_type = content_type
+        self.format = format
+        self.pages = pages
+        self.output = None
+        self.error = None
+        self.status = 200
+        if format:
+            self.output_name = '%s.%s' % (name.rsplit('.', 1)[0], format)
+        else:
+            self.output_name = name
+
+    def fail(self, error, status=500):
+        self.error = error
+        self.status = status
+
+
+def safe_name(name, default):
+    """
+    The base name of an uploaded file name without control characters, or
+    default if nothing is left.
+    """
+    name = name.replace('\\', '/').rsplit('/', 1)[-1]
+    return CONTROL_CHARACTERS.sub('', name) or default
+
+
+def unique_name(name, names):
+    """
+    name, numbered if it is already one of names, which it is added to.
+    """
+    base, dot, extension = name.rpartition('.')
+    if not dot:
+        base, extension = name, ''
+    unique, i = name, 1
+
+    while unique in names:
+        i += 1
+        unique = '%s-%i%s%s' % (base, i, dot, extension)
+
+    names.add(unique)
+    return unique
+
+
+def item_options(request, headers=None, options=None):
+    """
+    Format and pages for an item, from part headers or a manifest entry,
+    falling back to the querystring.
+    """
+    headers, options = headers or {}, options or {}
+    if not isinstance(options, dict):
+        raise web.HTTPBadRequest(reason='Invalid manifest entry')
+    format = headers.get('X-Format') or options.get('format') or \
+        request.query.get('format', 'pdf')
+    if format not in CONTENT_TYPES:
+        raise web.HTTPBadRequest(reason='Invalid format %s' % format)
+    pages = headers.get('X-Pages') or options.get('pages') or \
+        request.query.get('pages')
+    if pages is not None and not isinstance(pages, str):
+        raise web.HTTPBadRequest(reason='Invalid param pages')
+    return format, parse_pages(pages)
+
+
+def new_item(request, name, content_type, headers=None, options=None):
+    """
+    A BatchItem for a document, failed with status 400 when it's options are
+    invalid, so the rest of the batch is not affected.
+    """
+    try:
+        return BatchItem(name, content_type,
+                         *item_options(request, headers, options))
+
+    except web.HTTPBadRequest as e:
+        item = BatchItem(name, content_type)
+        item.fail(e.reason, 400)
+        return item
+
+
+async def iter_multipart(request):
+    """
+    Yield (item, temp) for each part of a multipart upload as it arrives, temp
+    is None for an item that failed already.
+    """
+    reader = await request.multipart()
+    i = 0
+
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+
+        i += 1
+        name = safe_name(part.filename or part.name or '', 'document-%i' % i)
+        content_type = part.headers.get('Content-Type') or guess_type(name)
+        item = new_item(request, name, content_type, headers=part.headers)
+        if item.error:
+            await part.release()
+            yield item, None
+            continue
+
+        temp = await NamedSpooledTemporaryFile(
+            max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR,
+            suffix=mimetypes.guess_extension(content_type))
+        try:
+            await copyfileobj(_PartReader(part), temp, length=MAX_CHUNK)
+
+        except BaseException:
+            await temp.close()
+            raise
+
+        yield item, temp
+
+
+async def iter_zip(request):
+    """
+    Yield (item, temp) for each member of a zip upload, temp is None for an
+    item that failed already.
+
+    A zip can only be read once complete, so it is spooled first. An optional
+    manifest.json member maps member names to format and pages.
+    """
+    loop = asyncio.get_running_loop()
+
+    async with NamedSpooledTemporaryFile(
+        max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR, suffix='.zip') as upload:
+
+        await copyfileobj(request.content, upload, length=MAX_CHUNK)
+        try:
+            archive = await loop.run_in_executor(
+                None, zipfile.ZipFile, upload._file)
+
+        except zipfile.BadZipFile:
+            raise web.HTTPBadRequest(reason='Invalid zip file')
+
+        manifest = {}
+        if 'manifest.json' in archive.namelist():
+            try:
+                manifest = json.loads(archive.read('manifest.json'))
+
+            except ValueError:
+                raise web.HTTPBadRequest(reason='Invalid manifest.json')
+
+            if not isinstance(manifest, dict):
+                raise web.HTTPBadRequest(reason='Invalid manifest.json')
+
+        for i, info in enumerate(archive.infolist(), 1):
+            if info.is_dir() or info.filename == 'manifest.json':
+                continue
+
+            name = safe_name(info.filename, 'document-%i' % i)
+            content_type = guess_type(name)
+            item = new_item(request, name, content_type,
+                            options=manifest.get(info.filename))
+            if item.error:
+                yield item, None
+                continue
+
+            temp = await NamedSpooledTemporaryFile(
+                max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR,
+                suffix=mimetypes.guess_extension(content_type))
+            try:
+                with archive.open(info) as member:
+                    await copyfileobj(_SyncReader(member, loop), temp,
+                                      length=MAX_CHUNK)
+
+            except BaseException:
+                await temp.close()
+                raise
+
+            yield item, temp
+
+
+def guess_type(name):
+    content_type, _ = mimetypes.guess_type(name)
+    return content_type or 'application/octet-stream'
+
+
+class _PartReader(object):
+    """
+    Adapts a multipart body part to the read() coroutine of copyfileobj().
+    """
+    def __init__(self, part):
+        self.part = part
+
+    async def read(self, length):
+        return await self.part.read_chunk(length)
+
+
+class _SyncReader(object):
+    """
+    Adapts a blocking file object to the read() coroutine of copyfileobj().
+    """
+    def __init__(self, f, loop):
+        self.f = f
+        self.loop = loop
+
+    async def read(self, length=-1):
+        return await self.loop.run_in_executor(None, self.f.read, length)
+
+
+class _ZipStream(object):
+    """
+    An unseekable file for zipfile that writes to a StreamResponse.
+
+    Used from an executor thread, each write waits for the response, so a slow
+    client slows down the writer.
+    """
+    def __init__(self, response, loop):
+        self.response = response
+        self.loop = loop
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(
+            self.response.write(bytes(data)), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _write_zip_member(z, item):
+    if item.error:
+        z.writestr(item.output_name + '.error.txt', item.error)
+        return
+
+    with item.output as src, z.open(item.output_name, 'w') as dst:
+        while True:
+            chunk = src.read(MAX_CHUNK)
+            if not chunk:
+                break
+            dst.write(chunk)
+
+
+async def _write_part(response, boundary, item, loop):
+    headers = [
+        "Content-Disposition: attachment; filename*=UTF-8''%s" % quote(
+            item.output_name),
+        'X-Source: %s' % item.name,
+    ]
+    if item.error:
+        headers += ['Content-Type: text/plain', 'X-Status: %i' % item.status]
+    else:
+        headers += ['Content-Type: %s' % CONTENT_TYPES[item.format],
+                    'X-Status: 200']
+
+    await response.write(('--%s\r\n%s\r\n\r\n' % (
+        boundary, '\r\n'.join(headers))).encode('utf8'))
+
+    if item.error:
+        await response.write(item.error.encode('utf8'))
+
+    else:
+        with item.output as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, MAX_CHUNK)
+                if not chunk:
+                    break
+                await response.write(chunk)
+
+    await response.write(b'\r\n')
+
+
+async def batch_handler(request):
+    '''
+    Convert many documents uploaded as multipart or zip in one request.
+
+    Documents are converted as they are read, at most BATCH_WINDOW at a time.
+    Results are streamed back in order of completion as multipart/mixed, or
+    as a zip when archive=zip is given. A failed item is reported in it's own
+    part (X-Status: 400 for invalid options, 500 otherwise) or as a .error.txt
+    member without failing the batch. Output names are made unique.
+
+    Conversions still running when the batch fails or the client goes away
+    are cancelled, and their outputs closed.
+    '''
+    loop = asyncio.get_running_loop()
+    archive = request.query.get('archive')
+    priority, client = get_priority(request, BULK), get_client(request)
+    timeout = get_timeout(request)
+    # Items are queued as they are read, the window bounds how many, so the
+    # batch is only subject to admission control as a whole.
+    SCHEDULER.check()
+
+    if request.content_type.startswith('multipart/'):
+        items = iter_multipart(request)
+
+    elif request.content_type in ('application/zip', 'application/x-zip-compressed'):
+        items = iter_zip(request)
+
+    else:
+        raise web.HTTPUnsupportedMediaType(reason='Send multipart or zip')
+
+    window = asyncio.Semaphore(BATCH_WINDOW)
+    done = asyncio.Queue()
+    tasks = set()
+    names = set()
+
+    async def run(item, temp):
+        try:
+            with SCHEDULER.admit(priority, client, bounded=False,
+                                 timeout=timeout) as job:
+                item.output = await convert(
+                    item.format, file=temp, content_type=item.content_type,
+                    pages=item.pages, size=await temp.tell(), job=job)
+
+        except Exception as e:
+            LOGGER.exception(e)
+            item.fail('%s: %s' % (e.__class__.__name__, e))
+
+        finally:
+            await temp.close()
+            window.release()
+            done.put_nowait(item)
+
+    async def read():
+        count = 0
+        while True:
+            # Wait for room in the window before reading the next document.
+            await window.acquire()
+            try:
+                item, temp = await items.__anext__()
+
+            except StopAsyncIteration:
+                window.release()
+                return count
+
+            count += 1
+            item.output_name = unique_name(item.output_name, names)
+            if temp is None:
+                window.release()
+                done.put_nowait(item)
+                continue
+
+            task = asyncio.ensure_future(run(item, temp))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    response = web.StreamResponse()
+    response.enable_chunked_encoding()
+    boundary = None
+    if archive == 'zip':
+        response.content_type = 'application/zip'
+
+    else:
+        boundary = uuid.uuid4().hex
+        response.headers['Content-Type'] = \
+            'multipart/mixed; boundary=%s' % boundary
+
+    reader = asyncio.ensure_future(read())
+    z = None
+    written = 0
+
+    try:
+        while not reader.done() or written < reader.result():
+            waiter = asyncio.ensure_future(done.get())
+            await asyncio.wait(
+                [waiter, reader], return_when=asyncio.FIRST_COMPLETED)
+            if not waiter.done():
+                waiter.cancel()
+                # Raise errors reading the upload.
+                reader.result()
+                continue
+
+            item = waiter.result()
+            if not response.prepared:
+                await response.prepare(request)
+            written += 1
+
+            if boundary:
+                await _write_part(response, boundary, item, loop)
+                continue
+
+            if z is None:
+                z = zipfile.ZipFile(
+                    _ZipStream(response, loop), 'w', zipfile.ZIP_STORED)
+            await loop.run_in_executor(None, partial(_write_zip_member, z, item))
+
+    finally:
+        reader.cancel()
+        if tasks:
+            # The batch failed or the client went away.
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+        while not done.empty():
+            item = done.get_nowait()
+            if item.output is not None:
+                item.output.close()
+
+    if not response.prepared:
+        await response.prepare(request)
+
+    if boundary:
+        await response.write(('--%s--\r\n' % boundary).encode('utf8'))
+
+    else:
+        if z is None:
+            z = zipfile.ZipFile(
+                _ZipStream(response, loop), 'w', zipfile.ZIP_STORED)
+        await loop.run_in_executor(None, z.close)
+
+    await response.write_eof()
+    return response
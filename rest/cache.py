@@ -0,0 +1,189 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import os.path
+
+from io import BytesIO
+from collections import OrderedDict
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def make_key(digest, format, pages=None, **options):
+    """
+    Derive a cache key from the input digest and the conversion options.
+    """
+    parts = [digest, format, '%s' % (pages,)]
+    for k, v in sorted(options.items()):
+        parts.append('%s=%s' % (k, v))
+    return hashlib.sha256(':'.join(parts).encode('utf8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of conversion results.
+
+    Hot entries are kept in memory, the rest in a directory on disk. Each tier
+    is bounded in bytes and evicts least recently used entries. Entries
+    evicted from memory are moved to disk, disk hits are moved back to memory
+    when they fit.
+
+    Entries for remote documents carry the origin's validators (ETag and
+    Last-Modified), used to revalidate them instead of fetching again.
+    """
+    def __init__(self, path, max_memory, max_disk):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.meta = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+        # The index is not persisted, so stale entries are discarded.
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_memory > 0 or self.max_disk > 0
+
+    def _path(self, key):
+        return os.path.join(self.path, key)
+
+    def _put_memory(self, key, data):
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            old_key, old_data = self.memory.popitem(last=False)
+            self.memory_size -= len(old_data)
+            self._put_disk(old_key, data=old_data)
+
+    def _put_disk(self, key, data=None, file=None, size=None):
+        if data is not None:
+            size = len(data)
+        if size > self.max_disk:
+            self.meta.pop(key, None)
+            return
+
+        with open(self._path(key), 'wb') as f:
+            if data is not None:
+                f.write(data)
+
+            else:
+                # Copy in the kernel, leaving the position of file alone.
+                offset = 0
+                while offset < size:
+                    offset += os.sendfile(
+                        f.fileno(), file.fileno(), offset, size - offset)
+
+        self.disk[key] = size
+        self.disk_size += size
+        while self.disk_size > self.max_disk:
+            old_key, old_size = self.disk.popitem(last=False)
+            self.disk_size -= old_size
+            self.meta.pop(old_key, None)
+            os.unlink(self._path(old_key))
+
+    def _discard(self, key):
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memory_size -= len(data)
+
+        size = self.disk.pop(key, None)
+        if size is not None:
+            self.disk_size -= size
+            os.unlink(self._path(key))
+
+        self.meta.pop(key, None)
+
+    def get(self, key):
+        """
+        Return a cached result or None.
+
+        Memory entries are returned as BytesIO, disk entries as an open file
+        which remains readable if the entry is evicted meanwhile.
+        """
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return BytesIO(data)
+
+            size = self.disk.get(key)
+            if size is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if size <= self.max_memory:
+                del self.disk[key]
+                self.disk_size -= size
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+                os.unlink(self._path(key))
+                self._put_memory(key, data)
+                return BytesIO(data)
+
+            self.disk.move_to_end(key)
+            return open(self._path(key), 'rb')
+
+    def validators(self, key):
+        """
+        Return the (etag, last_modified) stored with an entry or None.
+        """
+        with self.lock:
+            return self.meta.get(key)
+
+    def put(self, key, output, validators=None):
+        """
+        Store a conversion result, a BytesIO or an open file.
+
+        When validators are given, they replace an existing entry, the remote
+        document it was converted from has changed.
+        """
+        with self.lock:
+            if validators:
+                self._discard(key)
+
+            elif key in self.memory or key in self.disk:
+                return
+
+            if isinstance(output, BytesIO):
+                data = output.getvalue()
+                if len(data) <= self.max_memory:
+                    self._put_memory(key, data)
+
+                else:
+                    self._put_disk(key, data=data)
+
+            else:
+                size = os.fstat(output.fileno()).st_size
+                if size <= self.max_memory:
+                    self._put_memory(key, os.pread(output.fileno(), size, 0))
+
+                else:
+                    self._put_disk(key, file=output, size=size)
+
+            if validators and (key in self.memory or key in self.disk):
+                self.meta[key] = validators
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_size,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_size,
+            }
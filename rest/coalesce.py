@@ -0,0 +1,71 @@
+import os
+import asyncio
+import logging
+
+from io import BytesIO
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def share(output):
+    """
+    Another handle on a conversion output that can be sent and closed
+    independently.
+
+    Outputs are sent by path through /proc, which opens the file anew, so a
+    duplicate descriptor does not share the read position in practice.
+    """
+    if isinstance(output, BytesIO):
+        return BytesIO(output.getbuffer())
+    return os.fdopen(os.dup(output.fileno()), 'rb')
+
+
+class _Shared(object):
+    """
+    A conversion in flight and the number of requests waiting on it.
+    """
+    def __init__(self, future):
+        self.future = future
+        self.refs = 0
+
+    def _close(self):
+        if not self.future.cancelled() and self.future.exception() is None:
+            self.future.result().close()
+
+    def done(self, future):
+        if self.refs == 0:
+            self._close()
+
+    def release(self):
+        self.refs -= 1
+        if self.refs == 0 and self.future.done():
+            self._close()
+
+
+INFLIGHT = {}
+
+
+async def coalesce(key, fn):
+    """
+    Await fn() once for all concurrent calls with the same key.
+
+    Each caller gets it's own handle on the output. The conversion carries on
+    if the request that started it goes away while others still wait.
+    """
+    shared = INFLIGHT.get(key)
+    if shared is None:
+        shared = INFLIGHT[key] = _Shared(asyncio.ensure_future(fn()))
+        shared.future.add_done_callback(lambda f: INFLIGHT.pop(key, None))
+        shared.future.add_done_callback(shared.done)
+
+    else:
+        LOGGER.debug('Joining conversion in flight: %s', key)
+
+    shared.refs += 1
+    try:
+        return share(await asyncio.shield(shared.future))
+
+    finally:
+        shared.release()
@@ -6,6 +6,115 @@ MAX_CHUNK = int(os.environ.get('MAX_CHUNK', 16384))
 MAX_MEMORY = int(os.environ.get('MAX_MEMORY', 1024 ** 2 * 10))
 TEMP_DIR = os.environ.get('TEMP_DIR', tempfile.gettempdir())
 
-# NOTE: 1 is strongly encouraged, to restrict client connections to 1 at a
-# time.
-MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1))
+# Bytes of spooled input and output held in memory by all requests together.
+# Once used up new spools go straight to disk, and under pressure the spooled
+# input of queued jobs is moved to disk in the background. 0 disables the
+# budget, leaving only the MAX_MEMORY limit of each file.
+MEMORY_BUDGET = int(os.environ.get('MEMORY_BUDGET', 1024 ** 2 * 256))
+
+# NOTE: a single soffice instance is only stable when handling one client
+# connection at a time. Therefore one soffice instance is started per
+# concurrent conversion.
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", os.cpu_count() or 1))
+
+# HTTP worker processes. With more than one, this process runs the soffice
+# instances and a registry of the free ones on the REGISTRY_SOCKET Unix socket,
+# and starts WORKERS processes serving HTTP on the same port (SO_REUSEPORT)
+# which take instances from the registry for each conversion.
+WORKERS = int(os.environ.get('WORKERS', 1))
+REGISTRY_SOCKET = os.environ.get(
+    'REGISTRY_SOCKET', os.path.join(TEMP_DIR, 'officer-registry.sock'))
+# The number of this worker process, set by the main process for it's workers.
+WORKER = os.environ.get('OFFICER_WORKER')
+
+# How the UNO bridge reaches soffice, "pipe" (a named local pipe, a Unix domain
+# socket on Linux) or "socket" (TCP on localhost). Pipe names are unique per
+# host, process and instance, prefixed with SOFFICE_PIPE. With sockets instance
+# N listens on SOFFICE_PORT + N.
+SOFFICE_TRANSPORT = os.environ.get('SOFFICE_TRANSPORT', 'pipe')
+SOFFICE_PIPE = os.environ.get('SOFFICE_PIPE', 'officer')
+SOFFICE_PORT = int(os.environ.get('SOFFICE_PORT', 2002))
+
+# Extra soffice instances kept ready to take over while others are recycled.
+SOFFICE_SPARES = int(os.environ.get('SOFFICE_SPARES', 1))
+
+# An instance is restarted after this many conversions, when it's resident
+# memory exceeds RECYCLE_RSS bytes, or when it's recent conversions take
+# RECYCLE_DRIFT times longer than when it was fresh. 0 disables each.
+RECYCLE_CONVERSIONS = int(os.environ.get('RECYCLE_CONVERSIONS', 1000))
+RECYCLE_RSS = int(os.environ.get('RECYCLE_RSS', 1024 ** 3))
+RECYCLE_DRIFT = float(os.environ.get('RECYCLE_DRIFT', 3.0))
+
+# A soffice profile created ahead of time (see the Dockerfile), copied for
+# each instance instead of soffice creating one on first start.
+SOFFICE_PROFILE = os.environ.get('SOFFICE_PROFILE')
+
+# Convert a small document of each type on every instance after it starts,
+# before it takes work, so soffice has loaded it's modules.
+WARM_UP = os.environ.get('WARM_UP', '1') == '1'
+
+# Seconds between refreshes of the state reported by /live and /ready.
+HEALTH_INTERVAL = float(os.environ.get('HEALTH_INTERVAL', 5))
+
+# How long to wait for soffice to accept a bridge connection (seconds).
+SOFFICE_CONNECT_TIMEOUT = float(os.environ.get('SOFFICE_CONNECT_TIMEOUT', 30))
+
+# Byte limits for cached conversion results held in memory and in TEMP_DIR. A
+# limit of 0 disables that tier.
+CACHE_MEMORY = int(os.environ.get('CACHE_MEMORY', 1024 ** 2 * 64))
+CACHE_DISK = int(os.environ.get('CACHE_DISK', 1024 ** 3))
+
+# Stream output to clients while soffice is writing it, unless overridden by
+# the stream querystring argument. STREAM_QUEUE chunks may be buffered before
+# soffice is made to wait for the client.
+STREAM_OUTPUT = os.environ.get('STREAM_OUTPUT', '0') == '1'
+STREAM_QUEUE = int(os.environ.get('STREAM_QUEUE', 16))
+
+# The PDF export profile used unless the profile querystring argument is given,
+# web, print or archive (see profiles.py).
+PDF_PROFILE = os.environ.get('PDF_PROFILE', 'print')
+
+# Sharded PDF export (the shards querystring argument) splits a document into
+# at most MAX_SHARDS page ranges of at least SHARD_PAGES pages, each exported
+# on a separate instance at once.
+MAX_SHARDS = int(os.environ.get('MAX_SHARDS', MAX_CONCURRENCY))
+SHARD_PAGES = int(os.environ.get('SHARD_PAGES', 20))
+
+# The bounding box in pixels of PNG images rendered with thumbnail=1.
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))
+# The most pages a single request may render as PNG images.
+MAX_RASTER_PAGES = int(os.environ.get('MAX_RASTER_PAGES', 100))
+
+# The number of documents of a batch request read ahead and converting at
+# once.
+BATCH_WINDOW = int(os.environ.get('BATCH_WINDOW', MAX_CONCURRENCY * 2))
+
+# The number of jobs admitted but not yet running (including those still
+# uploading) above which requests are rejected with 429 Too Many Requests.
+MAX_QUEUE = int(os.environ.get('MAX_QUEUE', MAX_CONCURRENCY * 16))
+
+# The number of queued jobs that may fetch and spool their input ahead of
+# running, so an input is ready whenever an instance frees up. Others wait
+# (without their upload being read) until they near the head of the queue. 0
+# removes the limit.
+PREFETCH = int(os.environ.get('PREFETCH', MAX_CONCURRENCY * 2))
+
+# Seconds a conversion may run before it fails and it's soffice instance is
+# killed and restarted, unless overridden by the timeout querystring argument.
+# 0 disables the deadline.
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', 120))
+# The longest timeout a request may ask for, by default JOB_TIMEOUT. 0 for no
+# limit.
+MAX_JOB_TIMEOUT = float(os.environ.get('MAX_JOB_TIMEOUT', JOB_TIMEOUT))
+
+# Seconds the result of an asynchronous job is kept after it finishes.
+JOB_TTL = float(os.environ.get('JOB_TTL', 3600))
+
+# The conversion backend, soffice or fake. The fake backend simulates
+# conversions without LibreOffice, taking FAKE_LATENCY seconds plus the time to
+# read the input and write the output at FAKE_THROUGHPUT bytes per second. The
+# output is FAKE_OUTPUT_RATIO times the size of the input.
+BACKEND = os.environ.get('BACKEND', 'soffice')
+FAKE_LATENCY = float(os.environ.get('FAKE_LATENCY', 0.05))
+FAKE_THROUGHPUT = float(os.environ.get('FAKE_THROUGHPUT', 1024 ** 2 * 10))
+FAKE_OUTPUT_RATIO = float(os.environ.get('FAKE_OUTPUT_RATIO', 1.0))
@@ -0,0 +1,506 @@
+import os
+import time
+import pprint
+import logging
+import threading
+
+from io import BytesIO
+
+import uno
+import unohelper
+from com.sun.star.beans import PropertyValue
+from com.sun.star.lang import DisposedException
+from com.sun.star.connection import NoConnectException
+from com.sun.star.io import IOException, XInputStream, XOutputStream, XSeekable
+from com.sun.star.uno import Exception as UnoException, RuntimeException
+
+import filters
+import metrics
+
+from config import PDF_PROFILE, SOFFICE_CONNECT_TIMEOUT
+from filters import (
+    DEFAULT_FILTER, DRAWING, FILTERS, PRESENTATION, SPREADSHEET, TEXT,
+    export_filter, import_filter,
+)
+from profiles import PROFILES
+from sniff import sniff
+from spooled import SpooledOutput
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Errors meaning the bridge to soffice is gone.
+LOST_CONNECTION = (DisposedException, NoConnectException)
+
+FILTERS_LOCK = threading.Lock()
+FILTERS_VALIDATED = False
+
+
+def property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def property_tuple(d):
+    properties = []
+    for k, v in d.items():
+        properties.append(property(k, v))
+    return tuple(properties)
+
+
+# Properties for every document loaded.
+INPUT_PROPS = property_tuple({
+    "Hidden": True,
+    "MacroExecutionMode": 0,
+    "ReadOnly": True,
+    "Overwrite": True,
+    "OpenNewView": True,
+    "StartPresentation": False,
+    "RepairPackage": False,
+})
+
+
+def input_props(filter=None):
+    if filter:
+        return INPUT_PROPS + (property("FilterName", filter),)
+    return INPUT_PROPS
+
+
+def document_type(doc):
+    """
+    The document service of a loaded document, one of the FILTERS keys.
+
+    Only needed when soffice detected the type, otherwise it is known from the
+    import filter.
+    """
+    for k in FILTERS["pdf"]:
+        if doc.supportsService(k):
+            return k
+    return DEFAULT_FILTER
+
+
+def validate_filters(context):
+    """
+    Check the filter index against the filters of soffice, once.
+    """
+    global FILTERS_VALIDATED
+
+    with FILTERS_LOCK:
+        if FILTERS_VALIDATED:
+            return
+
+        factory = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.document.FilterFactory", context)
+        flags = {}
+        for name in filters.names():
+            if factory.hasByName(name):
+                props = {p.Name: p.Value for p in factory.getByName(name)}
+                flags[name] = props.get('Flags', 0)
+
+        filters.validate(flags)
+        FILTERS_VALIDATED = True
+
+
+def filter_data_property(data):
+    """
+    The FilterData property holding a tuple of PropertyValues.
+    """
+    return PropertyValue("FilterData", 0, uno.Any(
+        "[]com.sun.star.beans.PropertyValue", data), 0)
+
+
+# Properties for storing with each export filter, and the FilterData of each
+# PDF export profile, compiled once rather than on every store.
+STORE_PROPS = {
+    filter: property_tuple({"FilterName": filter, "Overwrite": True})
+    for filters in FILTERS.values() for filter in filters.values()
+}
+PROFILE_PROPS = {
+    name: filter_data_property(property_tuple(data))
+    for name, data in PROFILES.items()
+}
+
+
+def output_props(doc, format, pages=None, doc_type=None, filter_data=None,
+                 export=None):
+    """
+    Properties to store a document with.
+
+    PDF is exported with the profile and overrides given in export (see
+    params.get_export), other formats with filter_data alone.
+    """
+    filter = export_filter(format, doc_type or document_type(doc))
+    props = STORE_PROPS[filter]
+    filter_data = dict(filter_data or {})
+    if pages:
+        filter_data['PageRange'] = '%i-%i' % pages
+
+    if format != 'pdf':
+        if filter_data:
+            props += (filter_data_property(property_tuple(filter_data)),)
+        return props
+
+    export = dict(export or {})
+    profile = export.pop('profile', PDF_PROFILE)
+    filter_data.update(export)
+    if not filter_data:
+        return props + (PROFILE_PROPS[profile],)
+
+    return props + (filter_data_property(
+        property_tuple(dict(PROFILES[profile], **filter_data))),)
+
+
+def page_count(doc, doc_type):
+    """
+    The number of pages of a loaded document, or None if unknown.
+    """
+    try:
+        if doc_type in (PRESENTATION, DRAWING):
+            return doc.DrawPages.Count
+        if doc_type == TEXT:
+            return doc.CurrentController.PageCount
+        if doc_type == SPREADSHEET:
+            # Pages as printed, which lays out every sheet.
+            return doc.getRendererCount(doc, ())
+
+    except (AttributeError, UnoException):
+        pass
+
+
+def page_size(doc, doc_type):
+    """
+    The width and height of the (first) page of a loaded document in 1/100mm,
+    or None if unknown. Spreadsheets are laid out in the page style of their
+    first sheet.
+    """
+    try:
+        if doc_type in (PRESENTATION, DRAWING):
+            page = doc.DrawPages.getByIndex(0)
+            return page.Width, page.Height
+        if doc_type == TEXT:
+            name = doc.Text.createTextCursor().PageStyleName
+        elif doc_type == SPREADSHEET:
+            name = doc.Sheets.getByIndex(0).PageStyle
+        else:
+            return None
+
+        style = doc.StyleFamilies.getByName('PageStyles').getByName(name)
+        return style.Width, style.Height
+
+    except (AttributeError, UnoException):
+        pass
+
+
+def pixel_size(page, width=None, height=None, dpi=None):
+    """
+    The size in pixels to render a page of the given size (1/100mm) at.
+
+    width and height bound the image, keeping the aspect ratio of the page
+    when it is known. None to render at the default size.
+    """
+    if dpi:
+        if page is None:
+            return None
+        return (max(1, round(page[0] * dpi / 2540)),
+                max(1, round(page[1] * dpi / 2540)))
+
+    if not (width or height):
+        return None
+
+    if page is None:
+        return width or height, height or width
+
+    scale = min(width / page[0] if width else float('inf'),
+                height / page[1] if height else float('inf'))
+    return max(1, round(page[0] * scale)), max(1, round(page[1] * scale))
+
+
+def raster_data(doc, doc_type, image):
+    """
+    FilterData for the PNG export of a loaded document, image holds the
+    width, height and dpi requested.
+    """
+    size = pixel_size(page_size(doc, doc_type), **image) if image else None
+    if size is None:
+        return None
+    return {'PixelWidth': size[0], 'PixelHeight': size[1]}
+
+
+class InputStream(unohelper.Base, XInputStream, XSeekable):
+    """
+    Lets soffice read directly from a file object.
+
+    Reads are served in the chunk sizes soffice asks for from the BytesIO or
+    file backing the spooled request body, the body is never copied whole.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.f.seek(0, os.SEEK_END)
+        self.length = self.f.tell()
+        self.f.seek(0)
+
+    def readBytes(self, data, length):
+        chunk = self.f.read(length)
+        # NOTE: the out parameter is returned along with the return value.
+        return len(chunk), uno.ByteSequence(chunk)
+
+    def readSomeBytes(self, data, length):
+        return self.readBytes(data, length)
+
+    def skipBytes(self, length):
+        self.f.seek(length, os.SEEK_CUR)
+
+    def available(self):
+        return self.length - self.f.tell()
+
+    def closeInput(self):
+        # The file belongs to the request, it is closed by the handler.
+        pass
+
+    def seek(self, position):
+        self.f.seek(position)
+
+    def getPosition(self):
+        return self.f.tell()
+
+    def getLength(self):
+        return self.length
+
+
+class OutputStream(unohelper.Base, XOutputStream):
+    """
+    Hands output from soffice to a SpooledOutput or StreamingOutput.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+
+    def closeOutput(self):
+        self.sink.close_output()
+
+    def writeBytes(self, seq):
+        try:
+            self.sink.write(seq.value)
+
+        except IOError as e:
+            raise IOException(str(e), self)
+
+    def flush(self):
+        pass
+
+
+class Connection(object):
+    """
+    Manages a long-lived connection to a soffice instance.
+
+    The UNO bridge and Desktop are created once and reused for every
+    conversion performed on the instance. The connection is checked before
+    use and rebuilt if soffice went away in the meantime.
+
+    This class handles all the details of the conversion.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.context = uno.getComponentContext()
+        self.service_manager = self.context.ServiceManager
+        self.desktop = None
+
+    def connect(self, timeout=SOFFICE_CONNECT_TIMEOUT):
+        """
+        Resolve the bridge, waiting for soffice to start accepting.
+        """
+        resolver = self.service_manager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", self.context)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            try:
+                ctx = resolver.resolve('uno:%s' % self.address)
+                break
+
+            except NoConnectException:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+        self.desktop = ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", ctx)
+        LOGGER.info('Connected to soffice at %s', self.address)
+        validate_filters(ctx)
+
+    def alive(self):
+        """
+        Cheap check that the bridge is still usable, a single round trip.
+        """
+        if self.desktop is None:
+            return False
+
+        try:
+            self.desktop.getFrames()
+
+        except (DisposedException, RuntimeException):
+            return False
+
+        return True
+
+    def ensure(self):
+        if not self.alive():
+            self.desktop = None
+            self.connect()
+
+    def close(self):
+        self.desktop = None
+
+    def load(self, url=None, data=None, content_type=None, file=None,
+             format=''):
+        """
+        Load a document, returns it along with it's document type.
+        """
+        if data:
+            file = BytesIO(data)
+
+        # Choose the filters up front, rather than have soffice detect the
+        # type and ask the document for it.
+        extension = sniff(file, content_type)
+        filter, doc_type = import_filter(extension)
+        LOGGER.debug('Detected %s, import filter: %s', extension, filter)
+        in_props = input_props(filter)
+
+        if file:
+            url = "private:stream"
+            in_props += (property("InputStream", InputStream(file)),)
+
+        LOGGER.debug('in_url: %s', url)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('in_props: %s', pprint.pformat(in_props))
+
+        with metrics.phase('load', format) as labels:
+            doc = self.desktop.loadComponentFromURL(url, "_blank", 0, in_props)
+            doc_type = labels['doc_type'] = doc_type or document_type(doc)
+
+        try:
+            try:
+                doc.ShowChanges = False
+            except AttributeError:
+                pass
+
+            try:
+                doc.refresh()
+            except AttributeError:
+                pass
+
+        except Exception:
+            self.close_doc(doc)
+            raise
+
+        return doc, doc_type
+
+    def store(self, doc, format, pages=None, output=None, doc_type=None,
+              filter_data=None, export=None):
+        out_props = output_props(doc, format, pages, doc_type=doc_type,
+                                 filter_data=filter_data, export=export)
+
+        # Output is written to an anonymous file, unless the caller consumes
+        # it as it is written.
+        sink = output or SpooledOutput()
+        out_props += (property("OutputStream", OutputStream(sink)),)
+        out_url = "private:stream"
+
+        LOGGER.debug('out_url: %s', out_url)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('out_props: %s', pprint.pformat(out_props))
+
+        with metrics.phase('store', format, doc_type):
+            doc.storeToURL(out_url, out_props)
+
+        if output is None:
+            # NOTE: the file may have been replaced when rolled over.
+            output = sink.f
+            output.seek(0)
+
+        LOGGER.debug('%s as: %s', format, output.__class__)
+        return output
+
+    def close_doc(self, doc, format='', doc_type=''):
+        with metrics.phase('close', format, doc_type):
+            doc.dispose()
+            doc.close(True)
+
+    def convert(self, format, url=None, data=None, content_type=None, pages=None,
+                size=None, output=None, file=None, image=None, export=None):
+        # Ulitmately, this is the function called by convert()
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format=format)
+
+        try:
+            filter_data = None
+            if format == 'png':
+                filter_data = raster_data(doc, doc_type, image)
+            return self.store(doc, format, pages=pages, output=output,
+                              doc_type=doc_type, filter_data=filter_data,
+                              export=export)
+
+        finally:
+            self.close_doc(doc, format, doc_type)
+
+    def convert_many(self, targets, url=None, data=None, content_type=None,
+                     size=None, file=None):
+        """
+        Load the document once and store it once per (format, pages) target.
+        """
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file)
+
+        try:
+            return [
+                self.store(doc, format, pages=pages, doc_type=doc_type)
+                for format, pages in targets
+            ]
+
+        finally:
+            self.close_doc(doc, doc_type=doc_type)
+
+    def shard(self, split, url=None, data=None, content_type=None, size=None,
+              file=None, export=None):
+        """
+        Load the document, split it's pages with split(count) and export the
+        range it returns as PDF. count is None when it is not known.
+        """
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format='pdf')
+
+        try:
+            pages = split(page_count(doc, doc_type))
+            return self.store(doc, 'pdf', pages=pages, doc_type=doc_type,
+                              export=export)
+
+        finally:
+            self.close_doc(doc, 'pdf', doc_type)
+
+    def rasterize(self, pages, url=None, data=None, content_type=None,
+                  size=None, file=None, image=None):
+        """
+        Load the document once and render each of a range of pages as a PNG.
+
+        Returns a list of (page, file), the range is cut short at the last
+        page of the document when the page count is known.
+        """
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format='png')
+
+        try:
+            first, last = pages
+            count = page_count(doc, doc_type)
+            if count is not None:
+                last = min(last, count)
+            filter_data = raster_data(doc, doc_type, image)
+            return [
+                (page, self.store(doc, 'png', pages=(page, page),
+                                  doc_type=doc_type, filter_data=filter_data))
+                for page in range(first, last + 1)
+            ]
+
+        finally:
+            self.close_doc(doc, 'png', doc_type)
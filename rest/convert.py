@@ -1,406 +1,344 @@
-import os
-import sys
 import asyncio
-import subprocess
-import os.path
 import time
-import threading
-import tempfile
 import logging
-import mimetypes
-import pprint
 
 from functools import partial
-from io import BytesIO
 from concurrent.futures import ThreadPoolExecutor
-from tempfile import gettempdir
 
-import uno
-import unohelper
-from com.sun.star.beans import PropertyValue
-from com.sun.star.lang import DisposedException, IllegalArgumentException
-from com.sun.star.connection import NoConnectException
-from com.sun.star.io import IOException, XOutputStream
-from com.sun.star.script import CannotConvertException
-from com.sun.star.uno import RuntimeException
+import metrics
 
-from config import MAX_MEMORY, MAX_CONCURRENCY
+from config import (
+    BACKEND, MAX_CONCURRENCY, MAX_QUEUE, JOB_TIMEOUT, PREFETCH,
+    RECYCLE_CONVERSIONS, RECYCLE_DRIFT, RECYCLE_RSS, REGISTRY_SOCKET,
+    SOFFICE_SPARES, WARM_UP, WORKER, WORKERS,
+)
+from registry import RemotePool
+from scheduler import Scheduler
+from shards import split
+from soffice import SOfficePool
+from spooled import StreamingOutput
 
+if BACKEND == 'fake':
+    # Simulates conversions, to benchmark everything but soffice.
+    from fake import Connection, Instance, LOST_CONNECTION
 
-# A pool of workers to perform conversions.
+else:
+    from connection import Connection, LOST_CONNECTION
+    from soffice import SOffice as Instance
+
+
+# A pool of workers to perform conversions, one per soffice instance in use
+# at once.
 EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
 
-SOFFICE = None
+POOL = None
+# Queues jobs in front of the executor.
+SCHEDULER = None
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
-DEFAULT_FILTER = "com.sun.star.text.GenericTextDocument"
-FILTERS = {
-    "pdf": {
-        "com.sun.star.text.GenericTextDocument": "writer_pdf_Export",
-        "com.sun.star.sheet.SpreadsheetDocument": "calc_pdf_Export",
-        "com.sun.star.text.WebDocument": "writer_web_pdf_Export",
-        "com.sun.star.presentation.PresentationDocument": "impress_pdf_Export",
-        "com.sun.star.drawing.DrawingDocument": "draw_pdf_Export",
-    },
-    "png": {
-        "com.sun.star.text.GenericTextDocument": "writer_png_Export",
-        "com.sun.star.sheet.SpreadsheetDocument": "calc_png_Export",
-        "com.sun.star.text.WebDocument": "writer_web_png_Export",
-        "com.sun.star.presentation.PresentationDocument": "impress_png_Export",
-        "com.sun.star.drawing.DrawingDocument": "draw_png_Export",
-    }
-}
-IMPORT_FILTERS = {
-    '.bib': 'BibTeX_Writer',
-    '.bmp': 'draw_bmp_Export',
-    '.csv': 'Text - txt - csv (StarCalc)',
-    '.dbf': 'dBase',
-    '.dif': 'DIF',
-    '.doc': 'MS Word 97',
-    '.docx': 'Office Open XML Text',
-    '.emf': 'draw_emf_Export',
-    '.eps': 'draw_eps_Export',
-    '.fodg': 'OpenDocument Drawing Flat XML',
-    '.fodp': 'OpenDocument Presentation Flat XML',
-    '.fods': 'OpenDocument Spreadsheet Flat XML',
-    '.fodt': 'OpenDocument Text Flat XML',
-    '.gif': 'draw_gif_Export',
-    '.html': 'HTML (StarWriter)',
-    '.jpg': 'draw_jpg_Export',
-    '.ltx': 'LaTeX_Writer',
-    '.met': 'draw_met_Export',
-    '.odd': 'draw8',
-    '.odg': 'impress8_draw',
-    '.odp': 'impress8',
-    '.ods': 'calc8',
-    '.odt': 'writer8',
-    '.otg': 'draw8_template',
-    '.otp': 'impress8_template',
-    '.ots': 'calc8_template',
-    '.ott': 'writer8_template',
-    '.pbm': 'draw_pbm_Export',
-    '.pct': 'draw_pct_Export',
-    '.pdb': 'AportisDoc Palm DB',
-    '.pdf': 'writer_pdf_Export',
-    '.pgm': 'draw_pgm_Export',
-    '.png': 'draw_png_Export',
-    '.pot': 'MS PowerPoint 97 Vorlage',
-    '.potm': 'Impress MS PowerPoint 2007 XML Template',
-    '.ppm': 'draw_ppm_Export',
-    '.pps': 'MS PowerPoint 97 Autoplay',
-    '.ppt': 'MS PowerPoint 97',
-    '.pptx': 'Impress MS PowerPoint 2007 XML',
-    '.psw': 'PocketWord File',
-    '.pwp': 'placeware_Export',
-    '.pxl': 'Pocket Excel',
-    '.ras': 'draw_ras_Export',
-    '.rtf': 'Rich Text Format',
-    '.sda': 'StarDraw 5.0 (StarImpress)',
-    '.sdc': 'StarCalc 5.0',
-    '.sdd': 'StarImpress 5.0',
-    '.sdw': 'StarWriter 5.0',
-    '.slk': 'SYLK',
-    '.stc': 'calc_StarOffice_XML_Calc_Template',
-    '.std': 'draw_StarOffice_XML_Draw_Template',
-    '.sti': 'impress_StarOffice_XML_Impress_Template',
-    '.stw': 'writer_StarOffice_XML_Writer_Template',
-    '.svg': 'draw_svg_Export',
-    '.svm': 'draw_svm_Export',
-    '.swf': 'draw_flash_Export',
-    '.sxc': 'StarOffice XML (Calc)',
-    '.sxd': 'StarOffice XML (Draw)',
-    '.sxi': 'StarOffice XML (Impress)',
-    '.sxw': 'StarOffice XML (Writer)',
-    '.tiff': 'draw_tif_Export',
-    '.txt': 'Text',
-    '.uop': 'UOF presentation',
-    '.uos': 'UOF spreadsheet',
-    '.uot': 'UOF text',
-    '.vor': 'StarWriter 5.0 Vorlage/Template',
-    '.wmf': 'draw_wmf_Export',
-    '.wps': 'MS_Works',
-    '.xhtml': 'XHTML Calc File',
-    '.xls': 'MS Excel 97',
-    '.xlsx': 'Calc MS Excel 2007 XML',
-    '.xlt': 'MS Excel 97 Vorlage/Template',
-    '.xml': 'DocBook File',
-    '.xpm': 'draw_xpm_Export'
-}
-
-
-def property(name, value):
-    prop = PropertyValue()
-    prop.Name = name
-    prop.Value = value
-    return prop
-
-
-def property_tuple(d):
-    properties = []
-    for k, v in d.items():
-        properties.append(property(k, v))
-    return tuple(properties)
-
-
-def input_props(content_type):
-    props = {
-        "Hidden": True,
-        "MacroExecutionMode": 0,
-        "ReadOnly": True,
-        "Overwrite": True,
-        "OpenNewView": True,
-        "StartPresentation": False,
-        "RepairPackage": False,
-    }
-    extension = mimetypes.guess_extension(content_type)
-    if extension:
-        filter = IMPORT_FILTERS.get(extension)
-        if filter:
-            props["FilterName"] = filter
-    return property_tuple(props)
-
-
-def output_props(doc, format, pages=None):
-    filters = FILTERS[format]
-    filter = filters[DEFAULT_FILTER]
-    for k, v in filters.items():
-        if doc.supportsService(k):
-            filter = v
-            break
-    props = property_tuple({
-        "FilterName": filter,
-        "Overwrite": True,
-        "ReduceImageResolution": True,
-        "MaxImageResolution": 300,
-    })
-    if format == 'pdf':
-        props += (property("SelectPdfVersion", 1),)
-    if pages:
-        page_range = tuple([
-            PropertyValue('PageRange', 0, '%i-%i' % pages, 0)
-        ])
-        page_prop = uno.Any("[]com.sun.star.beans.PropertyValue", page_range)
-        props += tuple([
-            PropertyValue("FilterData", 0, page_prop, 0)
-        ])
-    return props
-
-
-class OutputStream(unohelper.Base, XOutputStream):
+# Small documents of each type, converted by new instances to load the
+# modules of soffice before real work arrives.
+_FLAT_ODF = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<office:document'
+    ' xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+    ' xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0"'
+    ' office:version="1.2"'
+    ' office:mimetype="application/vnd.oasis.opendocument.%s">'
+    '<office:body><office:%s><draw:page draw:name="1"/></office:%s>'
+    '</office:body></office:document>')
+WARM_UP_DOCUMENTS = (
+    ('text/plain', b'Warm up'),
+    ('text/csv', b'warm,up\n1,2\n'),
+    ('application/vnd.oasis.opendocument.presentation',
+     (_FLAT_ODF % (('presentation',) * 3)).encode('utf8')),
+    ('application/vnd.oasis.opendocument.graphics',
+     (_FLAT_ODF % ('graphics', 'drawing', 'drawing')).encode('utf8')),
+)
+
+
+def _log_arguments(*args, **kwargs):
+    for i, arg in enumerate(args):
+        LOGGER.debug('[%i]: %s', i, arg)
+    for n, v in kwargs.items():
+        try:
+            length = len(v)
+            if length > 100:
+                v = length
+        except (TypeError, ValueError):
+            pass
+        LOGGER.debug('["%s"]: %s', n, v)
+
+
+def _dispatch(job, method, *args, **kwargs):
     """
-    Simple class to receive output from soffice.
+    Run a Connection method on an idle soffice instance.
     """
-    def __init__(self):
-        self.f = BytesIO()
-        self.closed = False
+    pin = getattr(kwargs.get('file'), 'pin', None)
+    if pin:
+        # Running now, so the input must stay put while soffice reads it.
+        pin()
 
-    def closeOutput(self):
-        self.closed = True
+    if job.instance is not None:
+        # Acquired from the registry by the scheduler.
+        return _call(job.instance, method, *args, **kwargs)
+
+    with POOL.acquire() as soffice:
+        # Lets the scheduler kill the instance if the job overruns.
+        job.instance = soffice
+        return _call(soffice, method, *args, **kwargs)
 
-    def writeBytes(self, seq):
-        if self.closed:
-            raise IOError('write to closed stream')
-        try:
-            self.f.write(seq.value)
-        except Exception as e:
-            LOGGER.exception(e)
-            raise
 
-    def getvalue(self):
-        return self.f.getvalue()
+def _call(soffice, method, *args, **kwargs):
+    LOGGER.debug('Dispatched to %r', soffice)
+    if soffice.connection is None:
+        soffice.connection = Connection(soffice.address)
+    connection = soffice.connection
+    with metrics.phase('connect'):
+        connection.ensure()
 
-    def flush(self):
-        pass
+    try:
+        return getattr(connection, method)(*args, **kwargs)
 
+    except LOST_CONNECTION:
+        # The bridge is gone, the next job on this instance will rebuild it.
+        LOGGER.warning('Lost connection to %r', soffice)
+        connection.close()
+        raise
 
-class Connection(object):
+
+def _convert(job, format, *args, **kwargs):
+    LOGGER.debug('Converting document to %s, arguments...', format)
+    _log_arguments(*args, **kwargs)
+    return _dispatch(job, 'convert', format, *args, **kwargs)
+
+
+def _convert_many(job, targets, *args, **kwargs):
+    LOGGER.debug('Converting document to %s, arguments...', targets)
+    _log_arguments(*args, **kwargs)
+    return _dispatch(job, 'convert_many', targets, *args, **kwargs)
+
+
+def _rasterize(job, pages, *args, **kwargs):
+    LOGGER.debug('Rasterizing pages %s, arguments...', pages)
+    _log_arguments(*args, **kwargs)
+    return _dispatch(job, 'rasterize', pages, *args, **kwargs)
+
+
+def _input(kwargs):
     """
-    Manages connection to soffice.
+    Hand soffice the SpooledTemporaryFile behind an AsyncSpooledTemporaryFile,
+    it reads from it whether it is still in memory or rolled over to disk.
 
-    This class handles all the details of the conversion.
+    While the job is queued the file may be moved to disk to stay within the
+    memory budget.
     """
-    def __init__(self):
-        self.context = uno.getComponentContext()
-        self.service_manager = self.context.ServiceManager
-        resolver = self.service_manager.createInstanceWithContext(
-            "com.sun.star.bridge.UnoUrlResolver", self.context)
-        ctx = resolver.resolve('uno:%s' % SOffice.ADDRESS)
-        self.desktop = ctx.ServiceManager.createInstanceWithContext(
-            "com.sun.star.frame.Desktop", ctx)
-
-    def input_stream(self, data):
-        stream = self.service_manager.createInstanceWithContext(
-            "com.sun.star.io.SequenceInputStream", self.context)
-        seq = uno.ByteSequence(data)
-        # NOTE: the call below passes a tuple.
-        stream.initialize((seq,))
-        return stream, "private:stream"
-
-    def convert(self, format, url=None, data=None, content_type=None, pages=None,
-                size=None):
-        # Ulitmately, this is the function called by convert()
-        in_props = input_props(content_type)
-
-        if data:
-            in_stream, url = self.input_stream(data)
-            in_props += (property("InputStream", in_stream),)
-
-        LOGGER.debug('in_url: %s', url)
-        LOGGER.debug('in_props: %s', pprint.pformat(in_props))
-
-        for i in range(3):
-            try:
-                doc = self.desktop.loadComponentFromURL(
-                    url, "_blank", 0, in_props)
-                break
-
-            except Exception as e:
-                LOGGER.exception(e)
-                if i == 2:
-                    raise
-                LOGGER.info('Retrying connection to soffice')
-                time.sleep(0.5)
-
-        out_props = output_props(doc, format, pages)
-        out_stream = None
-
-        # We estimate the output size to be close to the input file size. If it
-        # is expected to be large, we write to disk.
-        if size <= MAX_MEMORY:
-            out_stream = OutputStream()
-            out_props += (property("OutputStream", out_stream),)
-            out_url = "private:stream"
-
-        else:
-            _fd, out_url = tempfile.mkstemp(suffix='.%s' % format)
-            os.close(_fd)
-            out_url = unohelper.systemPathToFileUrl(out_url)
-
-        LOGGER.debug('out_url: %s', out_url)
-        LOGGER.debug('out_props: %s', pprint.pformat(out_props))
+    f = kwargs.get('file')
 
-        try:
-            try:
-                doc.ShowChanges = False
-            except AttributeError:
-                pass
-            
-            try:
-                doc.refresh()
-            except AttributeError:
-                pass
-
-            doc.storeToURL(out_url, out_props)
-
-        finally:
-            doc.dispose()
-            doc.close(True)
-
-        if out_stream:
-            output = BytesIO(out_stream.getvalue())
-
-        else:
-            # NOTE: strip off file://
-            output = open(out_url[7:], 'rb')
-
-        LOGGER.debug('%s as: %s', format, output.__class__)
-        return output
+    if f:
+        kwargs['file'] = f._file
+        f._file.park()
 
 
-class SOffice(object):
+async def schedule(fn, job=None):
     """
-    Execute soffice and monitor process health.
+    Run fn(job) in the executor once it's turn comes.
 
-    This thread runs soffice, sends it's output to stdout / stderr and
-    restarts it if necessary.
+    job is the Job admitted for the request, work without one (health checks
+    for example) is queued without being subject to admission control.
     """
-    ADDRESS = "socket,host=localhost,port=2002,tcpNoDelay=1;urp;StarOffice.ComponentContext"
-    INSTALL_DIR = os.path.join(gettempdir(), "soffice")
-    COMMAND = [
-        "/usr/bin/soffice",
-        "-env:UserInstallation=file:///%s" % INSTALL_DIR,
-        "-env:JFW_PLUGIN_DO_NOT_CHECK_ACCESSIBILITY=1",
-        "--nologo",
-        "--headless",
-        "--invisible",
-        "--nocrashreport",
-        "--nodefault",
-        "--norestore",
-        "--safe-mode",
-        "--accept=%s" % ADDRESS,
-    ]
-
-    def __init__(self):
-        self.p = None
-        self.t = threading.Thread(target=self._run)
-        self.t.start()
-
-    def _run(self):
-        while True:
-            if self.p is None:
-                LOGGER.info('Starting soffice')
-                self.p = subprocess.Popen(
-                    SOffice.COMMAND,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-            
-            while self.p.poll() is None:
-                try:
-                    out, err = self.p.communicate(timeout=1.0)
-                    if out:
-                        LOGGER.info('soffice stdout: %s', out)
-                    if err:
-                        LOGGER.info('soffice stderr: %s', err)
-
-                except subprocess.TimeoutExpired:
-                    pass
-
-            LOGGER.warning('Exited with returncode: %s', self.p.returncode)
-            time.sleep(1.0)
-
-
-def _convert(format, *args, **kwargs):
-    LOGGER.debug('Converting document to %s, arguments...', format)
-    for i, arg in enumerate(args):
-        LOGGER.debug('[%i]: %s', i, arg)
-    for n, v in kwargs.items():
-        try:
-            length = len(v)
-            if length > 100:
-                v = length
-        except (TypeError, ValueError):
-            pass
-        LOGGER.debug('["%s"]: %s', n, v)
-    return Connection().convert(format, *args, **kwargs)
+    if job is None:
+        with SCHEDULER.admit(bounded=False) as job:
+            return await SCHEDULER.run(job, fn)
+
+    return await SCHEDULER.run(job, fn)
 
 
-async def convert(*args, **kwargs):
+async def convert(*args, stream=False, job=None, **kwargs):
+    """
+    Convert a document in the executor.
+
+    Returns the output as an open, anonymous file. When stream is True, the
+    conversion is queued and a StreamingOutput is returned right away,
+    the caller reads chunks from it as soffice writes them.
+    """
     loop = asyncio.get_running_loop()
-    # NOTE: the file argument is removed, our convert() function only handles
-    # a data buffer or url (which can be a local path).
-    f = kwargs.pop('file', None)
 
-    if f:
-        # An AsyncSpooledTemporaryFile has a SpooledTemporaryFile as it's
-        # _file attribute.
-        if hasattr(f, '_file') and getattr(f._file, '_rolled', None) is False:
-            # Get a reference to BytesIO.
-            f = f._file._file
-            kwargs['data'] = f.getvalue()
-            LOGGER.debug('Read %i bytes into buffer', kwargs['size'])
-
-        else:
-            kwargs['url'] = unohelper.systemPathToFileUrl(f._file.name)
-            LOGGER.debug('File is %i bytes', kwargs['size'])
+    if kwargs.get('file'):
+        _input(kwargs)
+        LOGGER.debug('File is %i bytes', kwargs['size'])
 
     # NOTE: we use an executor here for a few reasons:
     # - This call is blocking, so we want it in a background thread. Since it
     #   is mostly I/O, this should be a good choice.
-    # - We want to only have one request at a time to soffice. Since we have a
-    #   single threaded executor, we achieve this without extra work.
-    return await loop.run_in_executor(EXECUTOR, partial(_convert, *args, **kwargs))
+    # - We want to only have one request at a time per soffice instance. The
+    #   executor has one thread per instance and the scheduler runs at most
+    #   that many jobs, each thread acquires an idle instance from the pool
+    #   for the duration of the conversion.
+    if stream:
+        output = kwargs['output'] = StreamingOutput(loop)
+        output.future = asyncio.ensure_future(
+            schedule(lambda job: _convert(job, *args, **kwargs), job))
+        output.future.add_done_callback(output.done)
+        return output
+
+    return await schedule(lambda job: _convert(job, *args, **kwargs), job)
+
+
+async def convert_many(targets, job=None, **kwargs):
+    """
+    Convert a document to several (format, pages) targets with a single load.
+
+    Returns a list of open, anonymous files in the order of targets.
+    """
+    _input(kwargs)
+
+    return await schedule(
+        lambda job: _convert_many(job, targets, **kwargs), job)
+
+
+async def rasterize(pages, job=None, **kwargs):
+    """
+    Render a range of pages as PNG images with a single load.
+
+    Returns a list of (page, file) tuples.
+    """
+    _input(kwargs)
+
+    return await schedule(lambda job: _rasterize(job, pages, **kwargs), job)
+
+
+def _shard(job, method, path, *args, **kwargs):
+    """
+    Run a Connection method on a file of it's own, so shards can read the same
+    input at once.
+    """
+    with open(path, 'rb') as f:
+        return _dispatch(job, method, *args, file=f, **kwargs)
+
+
+async def _convert_shard(job, path, pages, **kwargs):
+    # Each shard is a job of it's own, queued like the request's.
+    with SCHEDULER.admit(job.priority, job.client, bounded=False,
+                         timeout=job.timeout) as shard:
+        return await SCHEDULER.run(shard, lambda shard: _shard(
+            shard, 'convert', path, 'pdf', pages=pages, **kwargs))
 
 
-# Start the process early.
-SOFFICE = SOffice()
+async def convert_sharded(shards, pages=None, job=None, file=None, **kwargs):
+    """
+    Export a document as PDF on up to shards instances at once, each
+    exporting a range of it's pages.
+
+    Yields (pages, file) in page order, each once it's shard and those before
+    it finished. The first shard loads the document, counts it's pages and
+    splits them, the other shards are queued as soon as the count is known.
+    """
+    loop = asyncio.get_running_loop()
+    divided = loop.create_future()
+
+    def divide(count):
+        ranges = split(pages, count, shards)
+        loop.call_soon_threadsafe(
+            lambda: divided.done() or divided.set_result(ranges))
+        return ranges[0]
+
+    # Shards open the input by name, so it must be on disk.
+    await file.rollover()
+    path = file.name
+    tasks = [asyncio.ensure_future(schedule(
+        lambda job: _shard(job, 'shard', path, divide, **kwargs), job))]
+    yielded = 0
+
+    try:
+        await asyncio.wait((divided, tasks[0]),
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not divided.done():
+            # The first shard failed before counting pages.
+            await tasks[0]
+        ranges = divided.result()
+        LOGGER.info('Exporting pages %s in %i shards', pages, len(ranges))
+
+        tasks.extend(
+            asyncio.ensure_future(_convert_shard(job, path, r, **kwargs))
+            for r in ranges[1:])
+        for r, task in zip(ranges, tasks):
+            output = await task
+            yielded += 1
+            yield r, output
+
+    finally:
+        divided.cancel()
+        for task in tasks[yielded:]:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result().close()
+
+
+def _warm(soffice):
+    """
+    Connect to a (re)started instance and warm it up, so it is ready before
+    it takes a job.
+    """
+    if soffice.connection is None:
+        soffice.connection = Connection(soffice.address)
+    connection = soffice.connection
+    connection.close()
+    with metrics.phase('connect'):
+        connection.ensure()
+
+    if not WARM_UP:
+        return
+
+    start = time.monotonic()
+    for content_type, data in WARM_UP_DOCUMENTS:
+        try:
+            connection.convert('pdf', data=data, content_type=content_type).close()
+
+        except Exception as e:
+            LOGGER.warning('Warm up of %r with %s failed: %s', soffice,
+                           content_type, e)
+
+    LOGGER.info('Warmed up %r in %.1fs', soffice, time.monotonic() - start)
+
+
+if WORKER is not None:
+    # soffice runs in the main process, instances are taken from it's
+    # registry before each job starts. The workers share the queue limit
+    # between them.
+    POOL = RemotePool(REGISTRY_SOCKET)
+    SCHEDULER = Scheduler(
+        EXECUTOR, MAX_CONCURRENCY, -(-MAX_QUEUE // WORKERS), JOB_TIMEOUT,
+        PREFETCH, acquire=POOL.acquire)
+
+else:
+    # Start the processes early.
+    POOL = SOfficePool(
+        MAX_CONCURRENCY, SOFFICE_SPARES, instance=Instance, warm=_warm,
+        max_conversions=RECYCLE_CONVERSIONS, max_rss=RECYCLE_RSS,
+        max_drift=RECYCLE_DRIFT)
+    SCHEDULER = Scheduler(
+        EXECUTOR, MAX_CONCURRENCY, MAX_QUEUE, JOB_TIMEOUT, PREFETCH)
+
+metrics.Gauge(
+    'officer_queue_depth', 'Jobs admitted and waiting to run.',
+    fn=lambda: SCHEDULER.pending)
+metrics.Gauge(
+    'officer_fetching_jobs',
+    'Jobs fetching their input or waiting to run with it ready.',
+    fn=lambda: SCHEDULER.fetching)
+metrics.Gauge(
+    'officer_running_jobs', 'Jobs running.', fn=lambda: SCHEDULER.running)
+metrics.Gauge(
+    'officer_soffice_rss_bytes', 'Resident memory of soffice instances.',
+    ('instance',),
+    fn=lambda: {(i.index,): i.rss() for i in POOL.instances})
+
+if WORKER is not None:
+    # The instances run in the main process, their metrics are asked from
+    # the registry.
+    for metric in metrics.REGISTRY:
+        if metric.name in metrics.SOFFICE_METRICS:
+            metric.fn = partial(POOL.samples, metric.name)
@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+
+import metrics
+
+from config import (
+    FAKE_LATENCY, FAKE_OUTPUT_RATIO, FAKE_THROUGHPUT, MAX_CHUNK,
+)
+from filters import TEXT, import_filter
+from sniff import sniff
+from soffice import SOffice
+from spooled import SpooledOutput
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# The fake bridge is never lost.
+LOST_CONNECTION = ()
+
+# The first bytes of output, so clients see the expected type.
+MAGIC = {
+    'pdf': b'%PDF-1.4\n',
+    'png': b'\x89PNG\r\n\x1a\n',
+}
+# Pages of every fake document.
+PAGES = 10
+
+
+class Document(object):
+    def __init__(self, size):
+        self.size = size
+
+
+class Connection(object):
+    """
+    Stands in for connection.Connection without soffice.
+
+    Conversions take FAKE_LATENCY seconds plus the time to read the input and
+    write the output at FAKE_THROUGHPUT bytes per second, and produce output of
+    FAKE_OUTPUT_RATIO times the size of the input.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.connected = False
+
+    def connect(self, timeout=None):
+        self.connected = True
+        LOGGER.info('Connected to fake soffice at %s', self.address)
+
+    def alive(self):
+        return self.connected
+
+    def ensure(self):
+        if not self.alive():
+            self.connect()
+
+    def close(self):
+        self.connected = False
+
+    def load(self, url=None, data=None, content_type=None, file=None,
+             format=''):
+        if data:
+            size = len(data)
+
+        elif file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(0)
+
+        else:
+            size = os.path.getsize(url[len('file://'):])
+
+        _, doc_type = import_filter(sniff(file, content_type))
+        with metrics.phase('load', format) as labels:
+            labels['doc_type'] = doc_type = doc_type or TEXT
+            time.sleep(FAKE_LATENCY + size / FAKE_THROUGHPUT)
+
+        return Document(size), doc_type
+
+    def store(self, doc, format, pages=None, output=None, doc_type=None,
+              filter_data=None, export=None):
+        sink = output or SpooledOutput()
+        remaining = doc.size * FAKE_OUTPUT_RATIO
+        if pages:
+            # Output and time in proportion to the pages exported.
+            remaining *= (min(pages[1], PAGES) - pages[0] + 1) / PAGES
+        remaining = max(len(MAGIC[format]), int(remaining))
+
+        with metrics.phase('store', format, doc_type):
+            time.sleep(remaining / FAKE_THROUGHPUT)
+            chunk = MAGIC[format]
+            while remaining > 0:
+                sink.write(chunk[:remaining])
+                remaining -= len(chunk)
+                chunk = b'\0' * MAX_CHUNK
+            sink.close_output()
+
+        if output is None:
+            output = sink.f
+            output.seek(0)
+        return output
+
+    def close_doc(self, doc, format='', doc_type=''):
+        pass
+
+    def convert(self, format, url=None, data=None, content_type=None, pages=None,
+                size=None, output=None, file=None, image=None, export=None):
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format=format)
+        return self.store(doc, format, pages=pages, output=output,
+                          doc_type=doc_type)
+
+    def convert_many(self, targets, url=None, data=None, content_type=None,
+                     size=None, file=None):
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file)
+        return [
+            self.store(doc, format, pages=pages, doc_type=doc_type)
+            for format, pages in targets
+        ]
+
+    def shard(self, split, url=None, data=None, content_type=None, size=None,
+              file=None, export=None):
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format='pdf')
+        return self.store(doc, 'pdf', pages=split(PAGES), doc_type=doc_type)
+
+    def rasterize(self, pages, url=None, data=None, content_type=None,
+                  size=None, file=None, image=None):
+        doc, doc_type = self.load(url=url, data=data, content_type=content_type,
+                                  file=file, format='png')
+        first, last = pages
+        return [
+            (page, self.store(doc, 'png', pages=(page, page),
+                              doc_type=doc_type))
+            for page in range(first, min(last, PAGES) + 1)
+        ]
+
+
+class _Process(object):
+    """
+    Stands in for the soffice process.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+
+class Instance(SOffice):
+    """
+    An soffice instance without a process, killing it "restarts" it at once.
+    """
+    def seed(self):
+        pass
+
+    def _run(self):
+        while True:
+            self.conversions, self.baseline, self.latency = 0, None, None
+            self.p = _Process()
+            self.killed.wait()
+            self.p = None
+            self.killed.clear()
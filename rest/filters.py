@@ -0,0 +1,158 @@
+import logging
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+TEXT = "com.sun.star.text.GenericTextDocument"
+SPREADSHEET = "com.sun.star.sheet.SpreadsheetDocument"
+WEB = "com.sun.star.text.WebDocument"
+PRESENTATION = "com.sun.star.presentation.PresentationDocument"
+DRAWING = "com.sun.star.drawing.DrawingDocument"
+
+DEFAULT_FILTER = TEXT
+# Export filters by format and document type.
+FILTERS = {
+    "pdf": {
+        TEXT: "writer_pdf_Export",
+        SPREADSHEET: "calc_pdf_Export",
+        WEB: "writer_web_pdf_Export",
+        PRESENTATION: "impress_pdf_Export",
+        DRAWING: "draw_pdf_Export",
+    },
+    "png": {
+        TEXT: "writer_png_Export",
+        SPREADSHEET: "calc_png_Export",
+        WEB: "writer_web_png_Export",
+        PRESENTATION: "impress_png_Export",
+        DRAWING: "draw_png_Export",
+    }
+}
+# Import filters by extension, along with the type of document they load, so
+# the export filter is known before the document is loaded.
+IMPORT_FILTERS = {
+    '.bmp': ('BMP - MS Windows', DRAWING),
+    '.csv': ('Text - txt - csv (StarCalc)', SPREADSHEET),
+    '.dbf': ('dBase', SPREADSHEET),
+    '.dif': ('DIF', SPREADSHEET),
+    '.doc': ('MS Word 97', TEXT),
+    '.docx': ('Office Open XML Text', TEXT),
+    '.emf': ('EMF - MS Windows Metafile', DRAWING),
+    '.eps': ('EPS - Encapsulated PostScript', DRAWING),
+    '.fodg': ('OpenDocument Drawing Flat XML', DRAWING),
+    '.fodp': ('OpenDocument Presentation Flat XML', PRESENTATION),
+    '.fods': ('OpenDocument Spreadsheet Flat XML', SPREADSHEET),
+    '.fodt': ('OpenDocument Text Flat XML', TEXT),
+    '.gif': ('GIF - Graphics Interchange', DRAWING),
+    '.html': ('HTML (StarWriter)', TEXT),
+    '.jpg': ('JPG - JPEG', DRAWING),
+    '.met': ('MET - OS/2 Metafile', DRAWING),
+    '.odg': ('draw8', DRAWING),
+    '.odp': ('impress8', PRESENTATION),
+    '.ods': ('calc8', SPREADSHEET),
+    '.odt': ('writer8', TEXT),
+    '.otg': ('draw8_template', DRAWING),
+    '.otp': ('impress8_template', PRESENTATION),
+    '.ots': ('calc8_template', SPREADSHEET),
+    '.ott': ('writer8_template', TEXT),
+    '.pbm': ('PBM - Portable Bitmap', DRAWING),
+    '.pct': ('PCT - Mac Pict', DRAWING),
+    '.pdb': ('AportisDoc Palm DB', TEXT),
+    '.pdf': ('draw_pdf_import', DRAWING),
+    '.pgm': ('PGM - Portable Graymap', DRAWING),
+    '.png': ('PNG - Portable Network Graphic', DRAWING),
+    '.pot': ('MS PowerPoint 97 Vorlage', PRESENTATION),
+    '.potm': ('Impress MS PowerPoint 2007 XML Template', PRESENTATION),
+    '.ppm': ('PPM - Portable Pixelmap', DRAWING),
+    '.pps': ('MS PowerPoint 97 Autoplay', PRESENTATION),
+    '.ppt': ('MS PowerPoint 97', PRESENTATION),
+    '.pptx': ('Impress MS PowerPoint 2007 XML', PRESENTATION),
+    '.psw': ('PocketWord File', TEXT),
+    '.pxl': ('Pocket Excel', SPREADSHEET),
+    '.ras': ('RAS - Sun Rasterfile', DRAWING),
+    '.rtf': ('Rich Text Format', TEXT),
+    '.sda': ('StarDraw 5.0 (StarImpress)', PRESENTATION),
+    '.sdc': ('StarCalc 5.0', SPREADSHEET),
+    '.sdd': ('StarImpress 5.0', PRESENTATION),
+    '.sdw': ('StarWriter 5.0', TEXT),
+    '.slk': ('SYLK', SPREADSHEET),
+    '.stc': ('calc_StarOffice_XML_Calc_Template', SPREADSHEET),
+    '.std': ('draw_StarOffice_XML_Draw_Template', DRAWING),
+    '.sti': ('impress_StarOffice_XML_Impress_Template', PRESENTATION),
+    '.stw': ('writer_StarOffice_XML_Writer_Template', TEXT),
+    '.svg': ('SVG - Scalable Vector Graphics', DRAWING),
+    '.svm': ('SVM - StarView Metafile', DRAWING),
+    '.sxc': ('StarOffice XML (Calc)', SPREADSHEET),
+    '.sxd': ('StarOffice XML (Draw)', DRAWING),
+    '.sxi': ('StarOffice XML (Impress)', PRESENTATION),
+    '.sxw': ('StarOffice XML (Writer)', TEXT),
+    '.tiff': ('TIF - Tag Image File', DRAWING),
+    '.txt': ('Text', TEXT),
+    '.uop': ('UOF presentation', PRESENTATION),
+    '.uos': ('UOF spreadsheet', SPREADSHEET),
+    '.uot': ('UOF text', TEXT),
+    '.vor': ('StarWriter 5.0 Vorlage/Template', TEXT),
+    '.wmf': ('WMF - MS Windows Metafile', DRAWING),
+    '.wps': ('MS_Works', TEXT),
+    '.xls': ('MS Excel 97', SPREADSHEET),
+    '.xlsx': ('Calc MS Excel 2007 XML', SPREADSHEET),
+    '.xlt': ('MS Excel 97 Vorlage/Template', SPREADSHEET),
+    '.xpm': ('XPM', DRAWING),
+}
+# Extensions mimetypes may return for the same types.
+ALIASES = {
+    '.htm': '.html',
+    '.jpe': '.jpg',
+    '.jpeg': '.jpg',
+    '.tif': '.tiff',
+    '.xht': '.html',
+    '.xhtml': '.html',
+}
+
+# Filter flags, from com.sun.star.document.FilterFlags.
+IMPORT = 0x1
+EXPORT = 0x2
+
+
+def import_filter(extension):
+    """
+    The import filter for an extension and the type of document it loads, or
+    (None, None) to leave detection to soffice.
+    """
+    extension = ALIASES.get(extension, extension)
+    return IMPORT_FILTERS.get(extension, (None, None))
+
+
+def export_filter(format, doc_type):
+    return FILTERS[format].get(doc_type) or FILTERS[format][DEFAULT_FILTER]
+
+
+def names():
+    """
+    The names of all filters used.
+    """
+    names = set(f for f, _ in IMPORT_FILTERS.values())
+    for filters in FILTERS.values():
+        names.update(filters.values())
+    return names
+
+
+def validate(flags):
+    """
+    Check the index against the filters soffice provides.
+
+    flags maps the name of each filter soffice has to it's flags. Import
+    filters that are missing or can not import are dropped, so soffice falls
+    back to detecting those types.
+    """
+    for extension, (name, _) in list(IMPORT_FILTERS.items()):
+        if not flags.get(name, 0) & IMPORT:
+            LOGGER.warning('Import filter %s for %s unavailable', name,
+                           extension)
+            del IMPORT_FILTERS[extension]
+
+    for format, filters in FILTERS.items():
+        for name in filters.values():
+            if not flags.get(name, 0) & EXPORT:
+                LOGGER.warning('Export filter %s for %s unavailable', name,
+                               format)
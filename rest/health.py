@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from aiohttp import web
+
+import metrics
+
+from convert import POOL, SCHEDULER
+from config import HEALTH_INTERVAL
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Health(object):
+    """
+    Liveness and readiness, refreshed in the background.
+
+    Probes are answered from the last check, so they never wait for or
+    compete with conversions.
+
+    Live while the threads monitoring soffice are running (soffice itself is
+    restarted as needed). Ready once every instance has started and warmed up,
+    while soffice is running and the queue has room. In a worker process the
+    state of soffice comes from the registry of the main process.
+    """
+    def __init__(self, pool, scheduler):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.live = True
+        self.ready = False
+        self.reason = 'Starting'
+
+    def check(self):
+        live, ready, reason = True, True, 'OK'
+
+        if not self.pool.live:
+            live, ready, reason = False, False, 'Monitor thread died'
+
+        elif not self.pool.ready:
+            ready, reason = False, 'soffice not ready'
+
+        elif self.scheduler.pending >= self.scheduler.max_queue:
+            ready, reason = False, 'Queue full'
+
+        if (live, ready) != (self.live, self.ready):
+            LOGGER.info('Live: %s, ready: %s (%s)', live, ready, reason)
+        self.live, self.ready, self.reason = live, ready, reason
+
+
+HEALTH = Health(POOL, SCHEDULER)
+
+metrics.Gauge(
+    'officer_ready', 'Whether the service reports ready.',
+    fn=lambda: int(HEALTH.ready))
+
+
+async def prober(app):
+    '''
+    Refresh HEALTH every HEALTH_INTERVAL seconds for the lifetime of the app.
+    '''
+    async def loop():
+        while True:
+            # Asking the registry of a worker's pool blocks.
+            await asyncio.get_running_loop().run_in_executor(
+                None, HEALTH.check)
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    task = asyncio.ensure_future(loop())
+    yield
+    task.cancel()
+
+
+def _response(ok, reason):
+    if ok:
+        return web.Response(text='OK')
+    return web.Response(text='ERROR: %s' % reason, status=503)
+
+
+async def live(request):
+    return _response(HEALTH.live, HEALTH.reason)
+
+
+async def ready(request):
+    return _response(HEALTH.ready, HEALTH.reason)
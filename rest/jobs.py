@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import mimetypes
+import os.path
+
+from functools import partial
+from aiohttp import web
+
+from convert import SCHEDULER, convert
+from config import MAX_CHUNK, MAX_MEMORY, TEMP_DIR, JOB_TTL, WORKER, WORKERS
+from params import (
+    get_client, get_export, get_pages, get_priority, get_raster, get_timeout,
+)
+from responses import CONTENT_TYPES, make_response
+from scheduler import BULK
+from spooled import NamedSpooledTemporaryFile, copyfileobj
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+JOBS_ROOT = os.path.join(TEMP_DIR, 'officer-jobs')
+# Each worker process keeps the jobs it ran in a directory of it's own.
+JOBS_DIR = os.path.join(JOBS_ROOT, WORKER or 'main')
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobRecord(object):
+    """
+    The state of an asynchronous conversion.
+    """
+    def __init__(self, format, callback=None, dir=JOBS_DIR):
+        self.id = uuid.uuid4().hex
+        self.format = format
+        self.callback = callback
+        self.dir = dir
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, '%s.%s' % (self.id, self.format))
+
+    @property
+    def state_path(self):
+        return os.path.join(self.dir, '%s.json' % self.id)
+
+    def save(self):
+        """
+        Record the state for other worker processes, which may be asked for
+        it.
+        """
+        if WORKERS < 2:
+            return
+
+        temp = self.state_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temp, self.state_path)
+
+    @classmethod
+    def find(cls, id):
+        """
+        A job of another worker process, from the state it saved, or None.
+        """
+        if WORKERS < 2 or not JOB_ID.match(id):
+            return None
+
+        for name in os.listdir(JOBS_ROOT):
+            dir = os.path.join(JOBS_ROOT, name)
+            try:
+                with open(os.path.join(dir, '%s.json' % id)) as f:
+                    state = json.load(f)
+
+            except (OSError, ValueError):
+                continue
+
+            record = cls(state['format'], dir=dir)
+            record.id = id
+            record.status = state['status']
+            record.error = state['error']
+            record.created = state['created']
+            record.finished = state['finished']
+            return record
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'format': self.format,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+            'url': '/jobs/%s' % self.id,
+        }
+
+
+JOBS = {}
+# Conversions in flight, the loop only keeps weak references to tasks.
+TASKS = set()
+
+
+def _save(output, path):
+    with output, open(path, 'wb') as f:
+        shutil.copyfileobj(output, f, MAX_CHUNK)
+
+
+async def notify(session, record):
+    try:
+        async with session.post(record.callback, json=record.to_dict()) as r:
+            LOGGER.info('Callback for job %s: %i', record.id, r.status)
+
+    except Exception as e:
+        LOGGER.warning('Callback for job %s failed: %s', record.id, e)
+
+
+async def run(session, record, job, temp, **kwargs):
+    loop = asyncio.get_running_loop()
+
+    try:
+        with job:
+            output = await convert(record.format, file=temp, job=job, **kwargs)
+        await loop.run_in_executor(None, partial(_save, output, record.path))
+        record.status = DONE
+
+    except Exception as e:
+        LOGGER.exception(e)
+        record.status = FAILED
+        record.error = '%s: %s' % (e.__class__.__name__, e)
+
+    finally:
+        record.finished = time.time()
+        record.save()
+        await temp.close()
+
+    if record.callback:
+        await notify(session, record)
+
+
+async def submit_handler(request):
+    '''
+    Spool the document and queue it's conversion, returning a job id.
+
+    The result is fetched from GET /jobs/{id}. If a callback URL is given, the
+    job status is POSTed to it as JSON once the job is finished.
+    '''
+    content_type = request.content_type
+    format = request.query.get('format', 'pdf')
+    if format not in CONTENT_TYPES:
+        raise web.HTTPBadRequest(reason='Invalid format %s' % format)
+    pages = get_pages(request)
+    if get_raster(format, pages):
+        raise web.HTTPBadRequest(reason='Job %s renders a single page' % format)
+    export = get_export(request) if format == 'pdf' else None
+    callback = request.query.get('callback')
+    extension = mimetypes.guess_extension(content_type)
+
+    job = SCHEDULER.admit(get_priority(request, BULK), get_client(request),
+                          timeout=get_timeout(request))
+
+    try:
+        temp = await NamedSpooledTemporaryFile(
+            max_size=MAX_MEMORY, mode='w+b', dir=TEMP_DIR, suffix=extension)
+        size = await copyfileobj(request.content, temp, length=MAX_CHUNK)
+
+    except BaseException:
+        job.close()
+        raise
+
+    record = JobRecord(format, callback)
+    JOBS[record.id] = record
+    record.save()
+    LOGGER.info('Job %s queued, %i bytes', record.id, size)
+
+    task = asyncio.ensure_future(run(
+        request.app['client'], record, job, temp, content_type=content_type,
+        pages=pages, size=size, export=export))
+    TASKS.add(task)
+    task.add_done_callback(TASKS.discard)
+
+    return web.json_response(record.to_dict(), status=202, headers={
+        'Location': '/jobs/%s' % record.id,
+    })
+
+
+async def status_handler(request):
+    '''
+    The result of a finished job, or it's status as JSON.
+    '''
+    id = request.match_info['id']
+    record = JOBS.get(id) or JobRecord.find(id)
+
+    if record is None:
+        raise web.HTTPNotFound(reason='No such job')
+
+    if record.status == QUEUED:
+        return web.json_response(record.to_dict(), status=202)
+
+    if record.status == FAILED:
+        return web.json_response(record.to_dict(), status=500)
+
+    try:
+        f = open(record.path, 'rb')
+
+    except FileNotFoundError:
+        raise web.HTTPNotFound(reason='Job result expired')
+
+    return make_response(f, record.format)
+
+
+def expire():
+    """
+    Forget finished jobs older than JOB_TTL and remove their results.
+    """
+    now = time.time()
+
+    for id, record in list(JOBS.items()):
+        if record.finished is None or now - record.finished < JOB_TTL:
+            continue
+
+        del JOBS[id]
+        for path in (record.path, record.state_path):
+            try:
+                os.unlink(path)
+
+            except FileNotFoundError:
+                pass
+
+
+async def cleanup(app):
+    '''
+    Run expire() periodically for the lifetime of the app.
+
+    Jobs do not survive a restart, so results left by a previous run of this
+    process (or worker) are removed.
+    '''
+    shutil.rmtree(JOBS_DIR, ignore_errors=True)
+    os.makedirs(JOBS_DIR, exist_ok=True)
+
+    async def loop():
+        while True:
+            await asyncio.sleep(max(1, JOB_TTL / 10))
+            expire()
+
+    task = asyncio.ensure_future(loop())
+    yield
+    task.cancel()
@@ -0,0 +1,182 @@
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+
+
+# Every metric created, in order, for rendering.
+REGISTRY = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values))
+
+
+class Metric(object):
+    """
+    Base of the metric types, values are kept per tuple of label values.
+
+    Updates only take a lock and touch a dict, so they are cheap enough to
+    call on every conversion from any thread. Values kept elsewhere are read
+    from fn when rendered instead, fn returns a number, or a dict of label
+    value tuples to numbers.
+    """
+    TYPE = None
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.fn = fn
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def samples(self):
+        if self.fn is not None:
+            values = self.fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [(self.name, key, value) for key, value in values.items()]
+
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.TYPE),
+        ]
+        for name, key, value in self.samples():
+            lines.append('%s%s %s' % (
+                name, _format_labels(self.labels, key), value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that is set, or read from fn when rendered.
+    """
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+        60.0, 120.0,
+    )
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Per bucket counts (the last is +Inf), then the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for _, key, counts in super(Histogram, self).samples():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                total += count
+                samples.append(('%s_bucket' % self.name, key + (bound,), total))
+            samples.append(('%s_sum' % self.name, key, counts[-1]))
+            samples.append(('%s_count' % self.name, key, total))
+        return samples
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.TYPE),
+        ]
+        for name, key, value in self.samples():
+            labels = self.labels
+            if name.endswith('_bucket'):
+                labels += ('le',)
+            lines.append('%s%s %s' % (name, _format_labels(labels, key), value))
+        return '\n'.join(lines)
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+PHASE_SECONDS = Histogram(
+    'officer_phase_seconds', 'Time spent in each phase of a conversion.',
+    ('phase', 'format', 'doc_type'))
+QUEUE_WAIT_SECONDS = Histogram(
+    'officer_queue_wait_seconds',
+    'Time from admission until a job starts running.', ('priority',))
+REJECTED = Counter(
+    'officer_rejected_total', 'Requests rejected because the queue was full.')
+TIMEOUTS = Counter(
+    'officer_timeouts_total', 'Jobs that exceeded their deadline.')
+SPOOLED_BYTES = Counter(
+    'officer_spooled_bytes_total', 'Bytes of input spooled.', ('storage',))
+BUDGET_ROLLOVERS = Counter(
+    'officer_budget_rollovers_total',
+    'Spools moved to disk, or created there, because of the memory budget.',
+    ('reason',))
+SOFFICE_RESTARTS = Counter(
+    'officer_soffice_restarts_total', 'Times soffice was restarted.',
+    ('instance',))
+SOFFICE_RECYCLES = Counter(
+    'officer_soffice_recycles_total',
+    'Times an instance was taken out of service to restart it.',
+    ('instance', 'reason'))
+# Metrics of the soffice instances. With WORKERS > 1 those live in the main
+# process, which serves them to the workers through the registry.
+SOFFICE_METRICS = (
+    'officer_soffice_rss_bytes', SOFFICE_RESTARTS.name, SOFFICE_RECYCLES.name,
+)
+
+
+@contextmanager
+def phase(name, format='', doc_type=''):
+    """
+    Time a phase of a conversion.
+
+    Yields the labels, so those only known during the phase (like doc_type)
+    can be filled in.
+    """
+    labels = {'phase': name, 'format': format, 'doc_type': doc_type}
+    start = time.perf_counter()
+    try:
+        yield labels
+
+    finally:
+        PHASE_SECONDS.observe(time.perf_counter() - start, **labels)
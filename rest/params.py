@@ -0,0 +1,202 @@
+import math
+
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+from config import (
+    MAX_JOB_TIMEOUT, MAX_RASTER_PAGES, MAX_SHARDS, PDF_PROFILE, STREAM_OUTPUT,
+    THUMBNAIL_SIZE,
+)
+from profiles import PROFILES, parse_overrides
+from responses import CONTENT_TYPES
+from scheduler import INTERACTIVE, PRIORITIES
+from shards import MERGE
+
+
+def get_stream(request):
+    stream = request.query.get('stream')
+    if stream is None:
+        return STREAM_OUTPUT
+    return stream in ('1', 'true', 'yes')
+
+
+def get_pages(request):
+    return parse_pages(request.query.get('pages'))
+
+
+def get_targets(request):
+    targets = []
+
+    for value in request.query.getall('target', []):
+        for target in value.split(','):
+            format, _, query = target.partition('?')
+            if format not in CONTENT_TYPES:
+                raise web.HTTPBadRequest(reason='Invalid target %s' % target)
+            pages = parse_pages(parse_qs(query).get('pages', [None])[0])
+            if get_raster(format, pages):
+                raise web.HTTPBadRequest(
+                    reason='Target %s renders a single page' % target)
+            targets.append((format, pages))
+
+    if not targets:
+        raise web.HTTPBadRequest(reason='Param target is required')
+
+    return targets
+
+
+def get_raster(format, pages):
+    """
+    Whether pages are rendered as an image each, a range of more than one page
+    as PNG. A range of more than MAX_RASTER_PAGES is refused.
+    """
+    if format != 'png' or not pages or pages[1] <= pages[0]:
+        return False
+
+    if pages[1] - pages[0] + 1 > MAX_RASTER_PAGES:
+        raise web.HTTPBadRequest(
+            reason='Param pages may span at most %i pages' % MAX_RASTER_PAGES)
+
+    return True
+
+
+def get_image(request):
+    """
+    Rendering options for PNG output, a dict of width, height (bounds in
+    pixels) and dpi, or None for the default size.
+
+    thumbnail=1 bounds the image to THUMBNAIL_SIZE pixels unless a width or
+    height is given.
+    """
+    image = {}
+
+    for name in ('width', 'height', 'dpi'):
+        value = request.query.get(name)
+        if not value:
+            continue
+
+        try:
+            value = int(value)
+
+        except ValueError:
+            raise web.HTTPBadRequest(reason='Invalid param %s' % name)
+
+        if value <= 0:
+            raise web.HTTPBadRequest(reason='Param %s must be positive' % name)
+
+        image[name] = value
+
+    thumbnail = request.query.get('thumbnail') in ('1', 'true', 'yes')
+    if thumbnail and not ('width' in image or 'height' in image):
+        image['width'] = image['height'] = THUMBNAIL_SIZE
+
+    return image or None
+
+
+def get_export(request):
+    """
+    Options of the PDF export, a dict of the profile name and any FilterData
+    overriding it.
+    """
+    profile = request.query.get('profile') or PDF_PROFILE
+    if profile not in PROFILES:
+        raise web.HTTPBadRequest(reason='Invalid param profile')
+
+    try:
+        return dict(parse_overrides(request.query), profile=profile)
+
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+
+
+def get_shards(request):
+    """
+    The number of instances to export PDF on at once, capped at MAX_SHARDS,
+    or None to export on one.
+
+    Shards are merged into one PDF, unless merge=0 asks for them as parts. A
+    merged PDF is refused rather than answered with parts where pypdf is
+    missing.
+    """
+    shards = request.query.get('shards')
+    if not shards:
+        return None
+
+    try:
+        shards = int(shards)
+
+    except ValueError:
+        raise web.HTTPBadRequest(reason='Invalid param shards')
+
+    if shards <= 0:
+        raise web.HTTPBadRequest(reason='Param shards must be positive')
+
+    shards = min(shards, MAX_SHARDS)
+    if shards == 1:
+        return None
+
+    if not MERGE and get_merge(request):
+        raise web.HTTPNotImplemented(
+            reason='Merging shards needs pypdf, pass merge=0 for parts')
+
+    return shards
+
+
+def get_merge(request):
+    return request.query.get('merge') != '0'
+
+
+def parse_pages(pages):
+    if pages:
+        try:
+            pages = tuple(map(int, pages.split('-')))
+
+        except ValueError:
+            raise web.HTTPBadRequest(reason='Invalid param pages')
+
+        if len(pages) != 2:
+            raise web.HTTPBadRequest(reason='Param pages must be in form: 1-?')
+
+    return pages
+
+
+def get_priority(request, default=INTERACTIVE):
+    priority = request.headers.get('X-Priority') or \
+        request.query.get('priority') or default
+    if priority not in PRIORITIES:
+        raise web.HTTPBadRequest(reason='Invalid param priority')
+    return priority
+
+
+def get_client(request):
+    """
+    Identifies the tenant for fair scheduling.
+    """
+    return request.headers.get('X-Client-Id') or request.remote
+
+
+def get_timeout(request):
+    """
+    Seconds the conversion may run, at most MAX_JOB_TIMEOUT, or None for the
+    default.
+    """
+    timeout = request.query.get('timeout')
+
+    if timeout:
+        try:
+            timeout = float(timeout)
+
+        except ValueError:
+            raise web.HTTPBadRequest(reason='Invalid param timeout')
+
+        if not math.isfinite(timeout):
+            raise web.HTTPBadRequest(reason='Invalid param timeout')
+
+        if timeout <= 0:
+            raise web.HTTPBadRequest(reason='Param timeout must be positive')
+
+        if MAX_JOB_TIMEOUT and timeout > MAX_JOB_TIMEOUT:
+            raise web.HTTPBadRequest(
+                reason='Param timeout must be at most %g' % MAX_JOB_TIMEOUT)
+
+    return timeout or None
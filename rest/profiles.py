@@ -0,0 +1,111 @@
+"""
+PDF export profiles and the per-request overrides of them.
+
+Profiles are FilterData of the PDF export filter, compiled to PropertyValues
+once by the backend. Overrides are validated here, so only known options with
+sane values ever reach soffice.
+"""
+
+# FilterData of the PDF export by profile.
+PROFILES = {
+    # Small files for viewing on screen.
+    'web': {
+        'UseLosslessCompression': False,
+        'Quality': 60,
+        'ReduceImageResolution': True,
+        'MaxImageResolution': 150,
+        'EmbedStandardFonts': False,
+        'ExportNotes': False,
+        'SelectPdfVersion': 0,
+    },
+    # Full quality images at printer resolution.
+    'print': {
+        'UseLosslessCompression': False,
+        'Quality': 90,
+        'ReduceImageResolution': True,
+        'MaxImageResolution': 300,
+        'EmbedStandardFonts': True,
+        'SelectPdfVersion': 0,
+    },
+    # Lossless, self-contained PDF/A-2b.
+    'archive': {
+        'UseLosslessCompression': True,
+        'ReduceImageResolution': False,
+        'EmbedStandardFonts': True,
+        'UseTaggedPDF': True,
+        'SelectPdfVersion': 2,
+    },
+}
+
+# Resolutions the PDF export offers, 0 keeps images as they are.
+RESOLUTIONS = (0, 75, 150, 300, 600, 1200)
+BOOLEANS = {
+    '1': True, 'true': True, 'yes': True,
+    '0': False, 'false': False, 'no': False,
+}
+
+
+def _integer(value):
+    try:
+        return int(value)
+
+    except ValueError:
+        raise ValueError('must be an integer')
+
+
+def _int(value, low, high):
+    value = _integer(value)
+    if not low <= value <= high:
+        raise ValueError('must be %i-%i' % (low, high))
+    return value
+
+
+def _bool(value):
+    try:
+        return BOOLEANS[value.lower()]
+
+    except KeyError:
+        raise ValueError('must be one of %s' % ', '.join(BOOLEANS))
+
+
+def _resolution(value):
+    value = _integer(value)
+    if value not in RESOLUTIONS:
+        raise ValueError('must be one of %s' % ', '.join(map(str, RESOLUTIONS)))
+    if not value:
+        return {'ReduceImageResolution': False}
+    return {'ReduceImageResolution': True, 'MaxImageResolution': value}
+
+
+# Querystring parameters overriding a profile, each parses a value into the
+# FilterData it sets, raising ValueError if invalid.
+OVERRIDES = {
+    'quality': lambda v: {'Quality': _int(v, 1, 100)},
+    'resolution': _resolution,
+    'lossless': lambda v: {'UseLosslessCompression': _bool(v)},
+    'fonts': lambda v: {'EmbedStandardFonts': _bool(v)},
+    # 0 for plain PDF, otherwise the PDF/A part (1b, 2b or 3b).
+    'pdfa': lambda v: {'SelectPdfVersion': _int(v, 0, 3)},
+}
+
+
+def parse_overrides(params):
+    """
+    FilterData overriding a profile from querystring params.
+
+    Raises ValueError naming the parameter if a value is invalid.
+    """
+    data = {}
+
+    for name, parse in OVERRIDES.items():
+        value = params.get(name)
+        if not value:
+            continue
+
+        try:
+            data.update(parse(value))
+
+        except ValueError as e:
+            raise ValueError('Param %s %s' % (name, e))
+
+    return data
@@ -0,0 +1,383 @@
+"""
+A registry of free soffice instances, shared by HTTP worker processes.
+
+With WORKERS > 1 the main process runs the soffice instances and serves the
+registry on a Unix socket, worker processes serve HTTP. A worker holds a
+registry connection for the duration of each conversion: an instance is
+acquired from the pool of the main process when it asks, and returned when it
+releases it or disconnects, so instances held by a worker that died are
+returned too.
+
+Workers ask on behalf of a job, with it's priority and client. Idle instances
+are handed out in the same order the scheduler of each worker runs it's own
+jobs, so priorities and clients taking turns hold across workers.
+
+Requests and replies are single lines of JSON.
+"""
+import os
+import json
+import select
+import socket
+import asyncio
+import logging
+import threading
+import socketserver
+
+from collections import OrderedDict, deque
+
+import metrics
+
+from scheduler import INTERACTIVE, PRIORITIES
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Seconds to wait for the registry to answer a status request.
+STATUS_TIMEOUT = 1.0
+# Seconds between checks whether a waiting worker gave up.
+WAIT_POLL = 0.5
+
+
+def _write(f, message):
+    f.write(json.dumps(message).encode('utf8') + b'\n')
+    f.flush()
+
+
+def _send(writer, message):
+    writer.write(json.dumps(message).encode('utf8') + b'\n')
+
+
+def _read(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf8'))
+
+
+class Turns(object):
+    """
+    Turns to take an idle instance, in order of priority and, within a
+    priority, clients taking turns.
+
+    One waiter at a time holds the turn, until it has taken an instance. At
+    most slots instances are held at once, spare instances only take over
+    while others are recycled.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self.cond = threading.Condition()
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.taking = False
+        self.held = 0
+
+    def _head(self):
+        for priority in PRIORITIES:
+            clients = self.queues[priority]
+            if clients:
+                return next(iter(clients.values()))[0]
+
+    def _take(self, priority, client):
+        clients = self.queues[priority]
+        waiters = clients.pop(client)
+        waiters.popleft()
+        if waiters:
+            # Move the client to the back of the line.
+            clients[client] = waiters
+
+    def _leave(self, priority, client, waiter):
+        clients = self.queues[priority]
+        clients[client].remove(waiter)
+        if not clients[client]:
+            del clients[client]
+
+    def wait(self, priority, client, gone):
+        """
+        Wait for the turn of a job of priority and client, True once it is
+        it's turn. False if gone() says the waiter gave up first.
+        """
+        if priority not in self.queues:
+            priority = INTERACTIVE
+        waiter = object()
+
+        with self.cond:
+            self.queues[priority].setdefault(client, deque()).append(waiter)
+
+            while self.taking or self.held >= self.slots or \
+                    self._head() is not waiter:
+                self.cond.wait(WAIT_POLL)
+                if gone():
+                    self._leave(priority, client, waiter)
+                    self.cond.notify_all()
+                    return False
+
+            self._take(priority, client)
+            self.taking = True
+            self.held += 1
+            return True
+
+    def done(self):
+        """
+        End the turn, once the instance was taken.
+        """
+        with self.cond:
+            self.taking = False
+            self.cond.notify_all()
+
+    def release(self):
+        """
+        Free the slot of an instance that was returned.
+        """
+        with self.cond:
+            self.held -= 1
+            self.cond.notify_all()
+
+    def __len__(self):
+        return sum(
+            len(waiters) for clients in self.queues.values()
+            for waiters in clients.values())
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Unbuffered, so select() sees whether the worker wrote anything.
+    rbufsize = 0
+
+    def handle(self):
+        request = _read(self.rfile)
+        if request is None:
+            return
+
+        if request['op'] == 'status':
+            _write(self.wfile, self.server.status())
+
+        elif request['op'] == 'metrics':
+            _write(self.wfile, self.server.metrics())
+
+        elif request['op'] == 'acquire':
+            self.acquire(request.get('priority'), request.get('client'))
+
+    def gone(self):
+        """
+        Whether the worker released the instance it is waiting for, or went
+        away.
+        """
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+
+        try:
+            request = _read(self.rfile)
+
+        except (OSError, ValueError):
+            return True
+
+        return request is None or request['op'] == 'release'
+
+    def acquire(self, priority, client):
+        turns = self.server.turns
+        if not turns.wait(priority, client, self.gone):
+            return
+
+        try:
+            with self.server.pool.acquire() as instance:
+                turns.done()
+                self.hold(instance)
+
+        finally:
+            turns.release()
+
+    def hold(self, instance):
+        _write(self.wfile, {
+            'index': instance.index, 'address': instance.address,
+        })
+
+        # Held until released, or the worker went away.
+        while True:
+            try:
+                request = _read(self.rfile)
+
+            except (OSError, ValueError):
+                request = None
+
+            if request is None:
+                # The worker died, soffice may still be busy with it's
+                # conversion.
+                instance.kill()
+                break
+
+            if request['op'] == 'release':
+                break
+
+            if request['op'] == 'kill':
+                instance.kill()
+
+
+class Registry(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the instances of pool to workers, a thread per connection, at
+    most slots at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, pool, path, slots):
+        self.pool = pool
+        self.turns = Turns(slots)
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, _Handler)
+
+    def status(self):
+        return {
+            'live': self.pool.live,
+            'ready': self.pool.ready,
+            'idle': self.pool.idle.qsize(),
+            'instances': len(self.pool),
+            'waiting': len(self.turns),
+        }
+
+    def metrics(self):
+        """
+        Samples of the soffice metrics by name, each the label values followed
+        by the value.
+        """
+        return {
+            metric.name: [
+                list(key) + [value] for _, key, value in metric.samples()]
+            for metric in metrics.REGISTRY
+            if metric.name in metrics.SOFFICE_METRICS
+        }
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        LOGGER.info('Registry of %i instances at %s', len(self.pool),
+                    self.server_address)
+
+
+class RemoteInstance(object):
+    """
+    An instance held through the registry, standing in for an SOffice in a
+    worker process. Released and killed from the event loop.
+    """
+    def __init__(self, pool, index, address, writer):
+        self.pool = pool
+        self.index = index
+        self.address = address
+        self.writer = writer
+
+    def __repr__(self):
+        return '<RemoteInstance %i: %s>' % (self.index, self.address)
+
+    # The worker's connection to the instance outlives holding it.
+    @property
+    def connection(self):
+        return self.pool.connections.get(self.index)
+
+    @connection.setter
+    def connection(self, connection):
+        self.pool.connections[self.index] = connection
+
+    def kill(self):
+        LOGGER.warning('Killing soffice %i', self.index)
+        _send(self.writer, {'op': 'kill'})
+
+    def release(self):
+        _send(self.writer, {'op': 'release'})
+        self.writer.close()
+
+
+class RemotePool(object):
+    """
+    The pool of the main process as seen from a worker process, through the
+    registry at path.
+
+    The scheduler of the worker acquires the instance of each job before it
+    starts, so jobs wait for their turn across all workers in the registry,
+    not in the executor.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connections = {}
+
+    def _connect(self, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    async def acquire(self, priority=INTERACTIVE, client=None):
+        '''
+        Wait for an idle instance for a job of priority and client, the
+        RemoteInstance must be released when done.
+        '''
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            _send(writer, {
+                'op': 'acquire', 'priority': priority, 'client': client,
+            })
+            line = await reader.readline()
+
+        except BaseException:
+            # Whether still waiting or just handed an instance, the registry
+            # takes this as giving up.
+            _send(writer, {'op': 'release'})
+            writer.close()
+            raise
+
+        if not line:
+            writer.close()
+            raise ConnectionError('Registry closed the connection')
+
+        reply = json.loads(line.decode('utf8'))
+        return RemoteInstance(self, reply['index'], reply['address'], writer)
+
+    def status(self):
+        """
+        The status of the pool, None if the registry can not be reached.
+        """
+        try:
+            with self._connect(STATUS_TIMEOUT) as sock, \
+                    sock.makefile('rwb') as f:
+                _write(f, {'op': 'status'})
+                return _read(f)
+
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Registry status failed: %s', e)
+
+    def samples(self, name):
+        """
+        The values of the soffice metric name by label values, empty if the
+        registry can not be reached.
+        """
+        try:
+            with self._connect(STATUS_TIMEOUT) as sock, \
+                    sock.makefile('rwb') as f:
+                _write(f, {'op': 'metrics'})
+                samples = _read(f) or {}
+
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Registry metrics failed: %s', e)
+            return {}
+
+        return {
+            tuple(sample[:-1]): sample[-1] for sample in samples.get(name, ())
+        }
+
+    @property
+    def live(self):
+        status = self.status()
+        return bool(status and status['live'])
+
+    @property
+    def ready(self):
+        status = self.status()
+        return bool(status and status['ready'])
+
+    def __len__(self):
+        status = self.status()
+        return status['instances'] if status else 0
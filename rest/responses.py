@@ -0,0 +1,157 @@
+import uuid
+import asyncio
+import logging
+import shutil
+import zipfile
+
+from functools import partial
+from io import BytesIO
+from aiohttp import web, MultipartWriter
+
+import metrics
+
+from config import MAX_CHUNK
+from spooled import SpooledOutput
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+CONTENT_TYPES = {
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+}
+
+
+class FileobjResponse(web.FileResponse):
+    '''
+    A FileResponse for an open, possibly anonymous, file.
+
+    The file is sent by path through /proc so aiohttp can use sendfile(), and
+    closed after the response.
+    '''
+    def __init__(self, f, *args, format='', **kwargs):
+        self._fileobj = f
+        self._format = format
+        super(FileobjResponse, self).__init__(
+            '/proc/self/fd/%i' % f.fileno(), *args, **kwargs)
+
+    async def prepare(self, *args, **kwargs):
+        try:
+            with metrics.phase('transfer', self._format):
+                return await super(FileobjResponse, self).prepare(
+                    *args, **kwargs)
+
+        finally:
+            self._fileobj.close()
+
+
+def make_response(pdf, format='pdf'):
+    if isinstance(pdf, BytesIO):
+        response = web.Response(body=pdf.getbuffer())
+
+    else:
+        response = FileobjResponse(pdf, format=format)
+
+    response.content_type = CONTENT_TYPES[format]
+    return response
+
+
+def multipart_response(items):
+    '''
+    Respond with several outputs as a multipart/mixed body.
+
+    items is a list of (name, format, file) tuples, the files are closed once
+    sent.
+    '''
+    writer = MultipartWriter('mixed')
+    for name, format, f in items:
+        part = writer.append(f, {'Content-Type': CONTENT_TYPES[format]})
+        part.set_content_disposition('attachment', filename=name)
+    return web.Response(body=writer)
+
+
+async def multipart_stream_response(request, items):
+    '''
+    Respond with several outputs as a multipart/mixed body, sending each as
+    soon as it is available.
+
+    items is an async iterator of (name, format, file) tuples, the files are
+    closed once sent. The response starts with the first item, so failures
+    before it can still be reported with a proper status.
+    '''
+    loop = asyncio.get_running_loop()
+    boundary = uuid.uuid4().hex
+    response = web.StreamResponse()
+    response.headers['Content-Type'] = \
+        'multipart/mixed; boundary="%s"' % boundary
+    response.enable_chunked_encoding()
+
+    try:
+        async for name, format, f in items:
+            with f:
+                if not response.prepared:
+                    await response.prepare(request)
+
+                await response.write((
+                    '--%s\r\nContent-Type: %s\r\n'
+                    'Content-Disposition: attachment; filename="%s"\r\n\r\n'
+                    % (boundary, CONTENT_TYPES[format], name)).encode('ascii'))
+                with metrics.phase('transfer', format):
+                    while True:
+                        chunk = await loop.run_in_executor(
+                            None, f.read, MAX_CHUNK)
+                        if not chunk:
+                            break
+                        await response.write(chunk)
+                await response.write(b'\r\n')
+
+    except Exception as e:
+        if not response.prepared:
+            raise
+
+        # Headers are sent, all we can do is abort so the client does not
+        # mistake a truncated body for a complete one.
+        LOGGER.exception(e)
+        request.transport.close()
+        return response
+
+    if not response.prepared:
+        await response.prepare(request)
+    await response.write(('--%s--\r\n' % boundary).encode('ascii'))
+    await response.write_eof()
+    return response
+
+
+def write_zip(items):
+    # The archive is charged to the memory budget and moves to disk like any
+    # other output. Outputs are mostly compressed already, so they are stored
+    # as-is.
+    sink = SpooledOutput()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as z:
+            for name, format, src in items:
+                with src, z.open(name, 'w') as dst:
+                    shutil.copyfileobj(src, dst, MAX_CHUNK)
+        sink.close_output()
+
+    except BaseException:
+        sink.f.close()
+        raise
+
+    sink.f.seek(0)
+    return sink.f
+
+
+async def zip_response(items):
+    '''
+    Respond with several outputs as a zip archive.
+
+    items is a list of (name, format, file) tuples, the files are closed once
+    written to the archive.
+    '''
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, partial(write_zip, items))
+    response = FileobjResponse(f)
+    response.content_type = 'application/zip'
+    return response
@@ -0,0 +1,327 @@
+import math
+import time
+import asyncio
+import logging
+
+from collections import OrderedDict, deque
+
+import metrics
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# In order of precedence.
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job can not be admitted, retry_after is a hint in seconds.
+    """
+    def __init__(self, retry_after):
+        super(QueueFull, self).__init__('Queue full')
+        self.retry_after = retry_after
+
+
+class JobTimeout(Exception):
+    """
+    Raised when a job runs past it's deadline.
+    """
+
+
+def _close(result):
+    """
+    Close the output, or outputs, of a job nobody waits for.
+    """
+    for output in result if isinstance(result, list) else [result]:
+        if hasattr(output, 'close'):
+            output.close()
+
+
+class Job(object):
+    """
+    An admitted unit of work.
+
+    A job counts towards the queue depth from admission (while it's input is
+    still being read) until it starts running or is closed. Once running,
+    instance is the soffice instance it was dispatched to. A job that was
+    granted a lookahead slot to fetch it's input holds it until then too, as
+    does a job waiting for the scheduler to acquire it's instance.
+    """
+    def __init__(self, scheduler, priority, client, timeout):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.client = client
+        self.timeout = timeout
+        self.admitted = time.monotonic()
+        self.fn = None
+        self.future = None
+        self.started = None
+        self.instance = None
+        self.timer = None
+        self.pending = True
+        self.fetching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.pending:
+            self.pending = False
+            self.scheduler.pending -= 1
+        if self.fetching:
+            self.fetching = False
+            self.scheduler._release()
+
+
+class Scheduler(object):
+    """
+    Admits jobs into a bounded queue and dispatches them to an executor.
+
+    Jobs run in order of priority class. Within a class, clients take turns
+    so a client with many queued jobs can not starve others. At most slots
+    jobs run at once, one per soffice instance.
+
+    A job running longer than it's timeout fails with JobTimeout and it's
+    soffice instance is killed, which also ends the blocked executor call.
+
+    Fetching and spooling input is pipelined with conversion: at most
+    lookahead jobs (in order of priority, clients taking turns) may be reading
+    their input or be waiting to run with their input ready. Further jobs wait to be granted a
+    slot by fetch(), so inputs are ready as soon as an instance is free
+    without every queued upload being read at once.
+
+    Given acquire, a coroutine function taking a job's priority and client,
+    the scheduler acquires the instance of each job before it starts, and
+    releases it when the job is done. Until then the job is still queued, it's
+    deadline has not started and it does not count as running. Queued jobs
+    wait for their instance all at once, whoever hands out instances decides
+    their order and how many run.
+    """
+    def __init__(self, executor, slots, max_queue, timeout=None,
+                 lookahead=None, acquire=None):
+        self.executor = executor
+        self.slots = slots
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.lookahead = lookahead
+        self.acquire = acquire
+        self.running = 0
+        self.acquiring = 0
+        self.pending = 0
+        self.fetching = 0
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.fetch_queues = {
+            priority: OrderedDict() for priority in PRIORITIES}
+        # Moving average of the time a job takes to run.
+        self.service_time = None
+
+    def retry_after(self):
+        service_time = self.service_time or 1.0
+        return max(1, math.ceil(service_time * (self.pending + 1) / self.slots))
+
+    def check(self):
+        """
+        Raise QueueFull if the queue is full.
+        """
+        if self.pending >= self.max_queue:
+            metrics.REJECTED.inc()
+            raise QueueFull(self.retry_after())
+
+    def admit(self, priority=INTERACTIVE, client=None, bounded=True,
+              timeout=None):
+        """
+        Admit a job, raising QueueFull if bounded and the queue is full.
+        """
+        if bounded:
+            self.check()
+
+        self.pending += 1
+        return Job(self, priority, client, timeout or self.timeout)
+
+    async def fetch(self, job):
+        """
+        Wait until job may fetch it's input.
+
+        The lookahead slot is released when the job starts running or is
+        closed.
+        """
+        if job.fetching:
+            return
+
+        if not self.lookahead or self.fetching < self.lookahead:
+            self.fetching += 1
+            job.fetching = True
+            return
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.fetch_queues[job.priority].setdefault(
+            job.client, deque()).append((job, waiter))
+        # If cancelled after the slot was granted, closing the job releases it.
+        await waiter
+
+    def _release(self):
+        self.fetching -= 1
+        while not self.lookahead or self.fetching < self.lookahead:
+            item = self._take(self.fetch_queues)
+            if item is None:
+                break
+
+            job, waiter = item
+            if waiter.done():
+                # The client went away while waiting.
+                continue
+            self.fetching += 1
+            job.fetching = True
+            waiter.set_result(None)
+
+    async def run(self, job, fn):
+        """
+        Queue fn as job, and return it's result once run in the executor.
+
+        fn is called with the job as it's argument.
+        """
+        loop = asyncio.get_running_loop()
+        job.fn = fn
+        job.future = loop.create_future()
+        self.queues[job.priority].setdefault(job.client, deque()).append(job)
+        self._dispatch()
+        return await job.future
+
+    @staticmethod
+    def _take(queues):
+        """
+        The next item of queues, keyed by priority and then client, in order
+        of priority with clients taking turns.
+        """
+        for priority in PRIORITIES:
+            clients = queues[priority]
+            if not clients:
+                continue
+
+            client, items = next(iter(clients.items()))
+            item = items.popleft()
+            # Move the client to the back of the line.
+            del clients[client]
+            if items:
+                clients[client] = items
+            return item
+
+    def _next(self):
+        return self._take(self.queues)
+
+    def _full(self):
+        return self.acquire is None and self.running >= self.slots
+
+    def _dispatch(self):
+        while not self._full():
+            job = self._next()
+            if job is None:
+                break
+
+            if job.future.cancelled():
+                # The client went away while waiting.
+                job.close()
+                continue
+
+            if self.acquire is None:
+                self._start(job)
+                continue
+
+            self.acquiring += 1
+            task = asyncio.ensure_future(
+                self.acquire(job.priority, job.client))
+            task.add_done_callback(
+                lambda task, job=job: self._acquired(job, task))
+            job.future.add_done_callback(
+                lambda future, task=task: future.cancelled() and task.cancel())
+
+    def _acquired(self, job, task):
+        self.acquiring -= 1
+
+        if task.cancelled():
+            job.close()
+
+        elif task.exception() is not None:
+            job.close()
+            if not job.future.done():
+                job.future.set_exception(task.exception())
+
+        elif job.future.done():
+            # The client went away at the last moment.
+            job.close()
+            task.result().release()
+
+        else:
+            job.instance = task.result()
+            self._start(job)
+
+        self._dispatch()
+
+    def _start(self, job):
+        loop = asyncio.get_running_loop()
+
+        job.close()
+        self.running += 1
+        job.started = time.monotonic()
+        LOGGER.debug('Job waited %.3fs', job.started - job.admitted)
+        metrics.QUEUE_WAIT_SECONDS.observe(
+            job.started - job.admitted, priority=job.priority)
+        task = loop.run_in_executor(self.executor, job.fn, job)
+        task.add_done_callback(lambda task, job=job: self._done(job, task))
+        if job.timeout:
+            job.timer = loop.call_later(job.timeout, self._expire, job)
+
+    def _expire(self, job):
+        LOGGER.warning('Job exceeded %.1fs deadline on %r', job.timeout,
+                       job.instance)
+        metrics.TIMEOUTS.inc()
+        if not job.future.done():
+            job.future.set_exception(
+                JobTimeout('Exceeded %.1fs deadline' % job.timeout))
+        if job.instance is not None:
+            job.instance.kill()
+
+    def _done(self, job, task):
+        self.running -= 1
+        if job.timer:
+            job.timer.cancel()
+        if self.acquire is not None:
+            job.instance.release()
+        elapsed = time.monotonic() - job.started
+        if self.service_time is None:
+            self.service_time = elapsed
+        else:
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+
+        exception = task.exception()
+        if job.future.done():
+            # Timed out or abandoned, the outcome is of no use.
+            if exception:
+                LOGGER.debug('Abandoned job failed: %r', exception)
+            else:
+                _close(task.result())
+
+        elif exception:
+            job.future.set_exception(exception)
+
+        else:
+            job.future.set_result(task.result())
+
+        self._dispatch()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'acquiring': self.acquiring,
+            'pending': self.pending,
+            'fetching': self.fetching,
+            'service_time': self.service_time,
+        }
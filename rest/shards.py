@@ -0,0 +1,81 @@
+"""
+Splitting the pages of a document into shards, and merging the PDF of each.
+
+Merging needs pypdf, a dependency of officer. Where it is missing, shards are
+only exported when their PDFs are asked for as they are.
+"""
+import logging
+
+try:
+    from pypdf import PdfWriter
+
+except ImportError:
+    PdfWriter = None
+
+from config import SHARD_PAGES
+from spooled import SpooledOutput
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+MERGE = PdfWriter is not None
+if not MERGE:
+    LOGGER.warning('pypdf is not installed, shards can not be merged')
+
+
+def split(pages, count, shards, min_pages=SHARD_PAGES):
+    """
+    Split pages (first, last), or all count pages if None, into at most
+    shards contiguous ranges of at least min_pages pages.
+
+    count is None when unknown, the range is then left whole.
+    """
+    if count is None:
+        return [pages]
+
+    first, last = pages or (1, count)
+    last = min(last, count)
+    total = last - first + 1
+    if total <= 0:
+        return [pages]
+
+    n = max(1, min(shards, total // max(1, min_pages)))
+    size, extra = divmod(total, n)
+    ranges = []
+    for i in range(n):
+        end = first + size + (1 if i < extra else 0) - 1
+        ranges.append((first, end))
+        first = end + 1
+    return ranges
+
+
+class Merger(object):
+    """
+    Appends the PDF of each shard in order, then writes them as one.
+
+    Shards can be appended as they finish while later ones still convert.
+    """
+    def __init__(self):
+        self.writer = PdfWriter()
+        self.files = []
+
+    def append(self, f):
+        self.files.append(f)
+        self.writer.append(f)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def write(self):
+        sink = SpooledOutput()
+        try:
+            self.writer.write(sink)
+            sink.close_output()
+
+        finally:
+            self.close()
+
+        sink.f.seek(0)
+        return sink.f
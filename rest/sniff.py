@@ -0,0 +1,227 @@
+import re
+import struct
+import zipfile
+import mimetypes
+
+
+# Bytes read from the start of a document to identify it.
+HEAD_SIZE = 8192
+
+# Content types that say nothing about the document.
+GENERIC_TYPES = {
+    None, '', 'application/octet-stream', 'application/x-www-form-urlencoded',
+    'binary/octet-stream',
+}
+
+SIGNATURES = (
+    (b'%PDF-', '.pdf'),
+    (b'{\\rtf', '.rtf'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'II*\x00', '.tiff'),
+    (b'MM\x00*', '.tiff'),
+    (b'BM', '.bmp'),
+    (b'\x01\x00\x00\x00', '.emf'),
+    (b'\xd7\xcd\xc6\x9a', '.wmf'),
+    (b'%!PS-Adobe-', '.eps'),
+)
+
+OLE2 = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+# Sector shifts of version 3 (512 byte) and 4 (4096 byte) compound documents.
+OLE2_SECTOR_SHIFTS = (9, 12)
+# Streams identifying the application of an OLE2 compound document.
+OLE2_STREAMS = (
+    ('WordDocument', '.doc'),
+    ('Workbook', '.xls'),
+    ('Book', '.xls'),
+    ('PowerPoint Document', '.ppt'),
+)
+
+ZIP = b'PK\x03\x04'
+ODF_TYPES = {
+    'application/vnd.oasis.opendocument.text': '.odt',
+    'application/vnd.oasis.opendocument.text-template': '.ott',
+    'application/vnd.oasis.opendocument.spreadsheet': '.ods',
+    'application/vnd.oasis.opendocument.spreadsheet-template': '.ots',
+    'application/vnd.oasis.opendocument.presentation': '.odp',
+    'application/vnd.oasis.opendocument.presentation-template': '.otp',
+    'application/vnd.oasis.opendocument.graphics': '.odg',
+    'application/vnd.oasis.opendocument.graphics-template': '.otg',
+}
+# Top level directories of Office Open XML packages.
+OOXML_PARTS = (
+    ('word/', '.docx'),
+    ('xl/', '.xlsx'),
+    ('ppt/', '.pptx'),
+)
+FLAT_ODF_TYPES = {
+    '.odt': '.fodt',
+    '.ods': '.fods',
+    '.odp': '.fodp',
+    '.odg': '.fodg',
+}
+FLAT_ODF_MIMETYPE = re.compile(rb'office:mimetype="([^"]+)"')
+# XML of no type known here, never taken for text.
+XML = '.xml'
+
+
+def _ole2(f, head):
+    """
+    Look for well known streams in the first sector of the directory.
+    """
+    if len(head) < 52:
+        return None
+
+    shift, = struct.unpack_from('<H', head, 30)
+    if shift not in OLE2_SECTOR_SHIFTS:
+        return None
+
+    sector_size = 1 << shift
+    first, = struct.unpack_from('<I', head, 48)
+    offset = (first + 1) * sector_size
+    f.seek(0, 2)
+    if offset + sector_size > f.tell():
+        return None
+
+    f.seek(offset)
+    directory = f.read(sector_size)
+
+    names = set()
+    for i in range(0, len(directory) - 127, 128):
+        length, = struct.unpack_from('<H', directory, i + 64)
+        names.add(directory[i:i + max(0, length - 2)].decode(
+            'utf-16-le', 'replace'))
+
+    for name, extension in OLE2_STREAMS:
+        if name in names:
+            return extension
+
+
+def _zip(f, head):
+    if len(head) < 30:
+        return None
+
+    # ODF packages start with an uncompressed mimetype member.
+    name_length, extra_length = struct.unpack_from('<HH', head, 26)
+    if head[30:30 + name_length] == b'mimetype':
+        size, = struct.unpack_from('<I', head, 18)
+        start = 30 + name_length + extra_length
+        return ODF_TYPES.get(
+            head[start:start + size].decode('ascii', 'replace'))
+
+    f.seek(0)
+    try:
+        names = zipfile.ZipFile(f).namelist()
+
+    except zipfile.BadZipFile:
+        return None
+
+    if '[Content_Types].xml' not in names:
+        return None
+
+    for prefix, extension in OOXML_PARTS:
+        if any(name.startswith(prefix) for name in names):
+            return extension
+
+
+def _html(start):
+    return b'<!doctype html' in start or b'<html' in start
+
+
+def _markup(head):
+    start = head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1024].lower()
+
+    if start.startswith(b'<?xml'):
+        match = FLAT_ODF_MIMETYPE.search(head)
+        if match:
+            return FLAT_ODF_TYPES.get(
+                ODF_TYPES.get(match.group(1).decode('ascii', 'replace')), XML)
+        if _html(start):
+            return '.html'
+        if b'<svg' in start:
+            return '.svg'
+        # Some other XML vocabulary (Word 2003 XML, SpreadsheetML, DocBook
+        # ...), it has no import filter of it's own so soffice detects it.
+        return XML
+
+    if _html(start):
+        return '.html'
+
+    if start.startswith(b'<svg'):
+        return '.svg'
+
+
+def _text(head, full):
+    """
+    CSV if the lines consistently contain a delimiter, otherwise plain text.
+    """
+    if b'\x00' in head:
+        return None
+
+    lines = head.decode('latin-1').splitlines()
+    if not full:
+        # The last line may be cut short.
+        lines = lines[:-1]
+    lines = [line for line in lines[:20] if line]
+
+    if len(lines) >= 2:
+        for delimiter in (',', ';', '\t'):
+            count = lines[0].count(delimiter)
+            if count and all(line.count(delimiter) == count for line in lines):
+                return '.csv'
+
+    return '.txt'
+
+
+def _magic(f, head):
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            if extension == '.emf' and head[40:44] != b' EMF':
+                continue
+            if extension == '.bmp' and head[6:10] != b'\x00\x00\x00\x00':
+                # Reserved bytes, "BM" alone is a likely start of text.
+                continue
+            return extension
+
+    if head.startswith(OLE2):
+        try:
+            return _ole2(f, head)
+
+        except (struct.error, OverflowError):
+            return None
+
+    if head.startswith(ZIP):
+        return _zip(f, head)
+
+    return _markup(head)
+
+
+def sniff(f=None, content_type=None):
+    """
+    The extension of a document's type, from it's content where it is
+    conclusive, otherwise from content_type. None if unknown, XML for XML
+    documents of a type left for soffice to detect.
+
+    f is a seekable binary file, it's position is left unchanged.
+    """
+    extension, head = None, None
+
+    if f is not None:
+        position = f.tell()
+        try:
+            f.seek(0)
+            head = f.read(HEAD_SIZE)
+            extension = _magic(f, head)
+
+        finally:
+            f.seek(position)
+
+    if extension is None and content_type not in GENERIC_TYPES:
+        extension = mimetypes.guess_extension(content_type)
+
+    if extension is None and head:
+        extension = _text(head, len(head) < HEAD_SIZE)
+
+    return extension
@@ -0,0 +1,356 @@
+import os
+import glob
+import time
+import queue
+import shutil
+import socket
+import logging
+import threading
+import subprocess
+import os.path
+
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import gettempdir
+
+import metrics
+
+from config import (
+    SOFFICE_PIPE, SOFFICE_PORT, SOFFICE_PROFILE, SOFFICE_TRANSPORT,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Tells the pipes and profiles of this process apart from those of other
+# officer processes on the host, or in other containers sharing /tmp.
+HOST = socket.gethostname()
+PROCESS = '%s-%i' % (HOST, os.getpid())
+
+
+class SOffice(object):
+    """
+    Execute soffice and monitor process health.
+
+    This thread runs soffice, sends it's output to stdout / stderr and
+    restarts it if necessary. Each instance accepts on it's own pipe, or port
+    SOFFICE_PORT + index with the socket transport, and uses it's own profile
+    directory, so several can run side by side.
+    """
+    TRANSPORTS = {
+        'pipe': 'pipe,name=%(pipe)s-%(process)s-%(index)i',
+        'socket': 'socket,host=localhost,port=%(port)i,tcpNoDelay=1',
+    }
+    ADDRESS = "%s;urp;StarOffice.ComponentContext"
+    INSTALL_DIR = os.path.join(gettempdir(), "soffice-%s-%i")
+    COMMAND = [
+        "/usr/bin/soffice",
+        "-env:JFW_PLUGIN_DO_NOT_CHECK_ACCESSIBILITY=1",
+        "--nologo",
+        "--headless",
+        "--invisible",
+        "--nocrashreport",
+        "--nodefault",
+        "--norestore",
+        "--safe-mode",
+    ]
+
+    # Conversions timed to establish the baseline latency of a fresh process.
+    BASELINE_SAMPLES = 20
+
+    def __init__(self, index=0, transport=SOFFICE_TRANSPORT):
+        self.index = index
+        self.address = SOffice.address_for(index, transport)
+        self.install_dir = SOffice.INSTALL_DIR % (PROCESS, index)
+        # The long-lived UNO connection to this instance, managed by the user
+        # of the pool.
+        self.connection = None
+        self.p = None
+        self.conversions = 0
+        self.baseline = None
+        self.latency = None
+        self.killed = threading.Event()
+        self.seed()
+        self.t = threading.Thread(target=self._run)
+        self.t.start()
+
+    def __repr__(self):
+        return '<SOffice %i: %s>' % (self.index, self.address)
+
+    @staticmethod
+    def address_for(index, transport=SOFFICE_TRANSPORT):
+        """
+        The UNO address of instance index, on a pipe or socket of it's own.
+        """
+        if transport not in SOffice.TRANSPORTS:
+            raise ValueError('Unknown transport: %s' % transport)
+
+        return SOffice.ADDRESS % (SOffice.TRANSPORTS[transport] % {
+            'pipe': SOFFICE_PIPE, 'process': PROCESS, 'index': index,
+            'port': SOFFICE_PORT + index,
+        })
+
+    @staticmethod
+    def remove_stale():
+        """
+        Remove the profiles left by officer processes on this host that have
+        exited.
+        """
+        prefix = SOffice.INSTALL_DIR % (HOST, 0)
+        prefix = prefix[:prefix.rindex(HOST) + len(HOST) + 1]
+
+        for path in glob.glob(glob.escape(prefix) + '*'):
+            try:
+                pid = int(path[len(prefix):].split('-')[0])
+                os.kill(pid, 0)
+                continue
+
+            except ValueError:
+                continue
+
+            except ProcessLookupError:
+                pass
+
+            except PermissionError:
+                # Running as another user.
+                continue
+
+            LOGGER.info('Removing stale profile %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def command_for(address, install_dir):
+        return SOffice.COMMAND + [
+            "-env:UserInstallation=%s" % Path(install_dir).as_uri(),
+            "--accept=%s" % address,
+        ]
+
+    @property
+    def command(self):
+        return SOffice.command_for(self.address, self.install_dir)
+
+    def seed(self):
+        """
+        Copy a profile prepared ahead of time, if any, so soffice does not
+        create one on first start.
+        """
+        if SOFFICE_PROFILE and os.path.isdir(SOFFICE_PROFILE) and \
+                not os.path.exists(self.install_dir):
+            LOGGER.info('Seeding profile %s from %s', self.install_dir,
+                        SOFFICE_PROFILE)
+            shutil.copytree(SOFFICE_PROFILE, self.install_dir, symlinks=True)
+
+    def rss(self):
+        """
+        Resident memory of the soffice process in bytes, 0 if not running.
+        """
+        p = self.p
+        if p is None:
+            return 0
+
+        try:
+            with open('/proc/%i/statm' % p.pid, 'rb') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def record(self, elapsed):
+        """
+        Account for a conversion that took elapsed seconds.
+        """
+        self.conversions += 1
+        if self.conversions <= SOffice.BASELINE_SAMPLES:
+            self.baseline = (
+                (self.baseline or 0) * (self.conversions - 1) + elapsed
+            ) / self.conversions
+            self.latency = self.baseline
+
+        else:
+            self.latency = 0.95 * self.latency + 0.05 * elapsed
+
+    def worn(self, max_conversions=0, max_rss=0, max_drift=0):
+        """
+        The reason this instance is due to be recycled, or None.
+        """
+        if max_conversions and self.conversions >= max_conversions:
+            return 'conversions'
+
+        if max_rss and self.rss() >= max_rss:
+            return 'rss'
+
+        if max_drift and self.conversions > SOffice.BASELINE_SAMPLES * 2 and \
+                self.latency > self.baseline * max_drift:
+            return 'latency'
+
+    def restart(self):
+        """
+        Kill soffice and wait for the monitor thread to start a fresh process.
+        """
+        p = self.p
+        self.kill()
+        while self.p is None or self.p is p:
+            time.sleep(0.1)
+
+    def _run(self):
+        started = False
+
+        while True:
+            if self.p is None:
+                LOGGER.info('Starting soffice %i', self.index)
+                if started:
+                    metrics.SOFFICE_RESTARTS.inc(instance=self.index)
+                started = True
+                self.conversions, self.baseline, self.latency = 0, None, None
+                self.p = subprocess.Popen(
+                    self.command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+
+            while self.p.poll() is None:
+                try:
+                    out, err = self.p.communicate(timeout=1.0)
+                    if out:
+                        LOGGER.info('soffice %i stdout: %s', self.index, out)
+                    if err:
+                        LOGGER.info('soffice %i stderr: %s', self.index, err)
+
+                except subprocess.TimeoutExpired:
+                    pass
+
+            LOGGER.warning('soffice %i exited with returncode: %s', self.index,
+                           self.p.returncode)
+            self.p = None
+
+            # Restart right away when killed on purpose, otherwise back off a
+            # little in case soffice is crashing on startup.
+            if not self.killed.is_set():
+                time.sleep(1.0)
+            self.killed.clear()
+
+    def kill(self):
+        """
+        Kill soffice, the monitor thread starts a fresh process.
+        """
+        p = self.p
+        if p is not None and p.poll() is None:
+            LOGGER.warning('Killing soffice %i', self.index)
+            self.killed.set()
+            p.kill()
+
+
+class SOfficePool(object):
+    """
+    A fixed set of soffice instances.
+
+    Every instance handles a single conversion at a time. Callers acquire an
+    idle instance, blocking until one is available, and return it when done.
+
+    Instances that are worn (by conversion count, memory or slowing down) are
+    recycled when returned: soffice is restarted in the background and warm
+    called to make it ready, before it rejoins the idle instances. Spare
+    instances beyond the number used at once take over meanwhile, so requests
+    do not wait for a cold start. Instances killed during a conversion are
+    made ready the same way, as are all instances when first started.
+    """
+    def __init__(self, size, spares=0, instance=SOffice, warm=None,
+                 max_conversions=0, max_rss=0, max_drift=0):
+        SOffice.remove_stale()
+        self.instances = [instance(i) for i in range(size + spares)]
+        self.warm = warm
+        self.max_conversions = max_conversions
+        self.max_rss = max_rss
+        self.max_drift = max_drift
+        self.idle = queue.Queue()
+        # Instances not yet made ready since the pool started.
+        self.starting = len(self.instances)
+        self.lock = threading.Lock()
+        for instance in self.instances:
+            if warm:
+                threading.Thread(
+                    target=self._start, args=(instance,), daemon=True).start()
+
+            else:
+                self.starting -= 1
+                self.idle.put(instance)
+
+    @property
+    def live(self):
+        """
+        Whether the threads monitoring soffice are running.
+        """
+        return all(i.t.is_alive() for i in self.instances)
+
+    @property
+    def ready(self):
+        """
+        Whether all instances were made ready, and at least one is running.
+        """
+        return self.starting == 0 and any(
+            i.p is not None and i.p.poll() is None for i in self.instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    @contextmanager
+    def acquire(self):
+        instance = self.idle.get()
+        p, start = instance.p, time.monotonic()
+        try:
+            yield instance
+
+        finally:
+            if instance.p is not p or instance.killed.is_set():
+                # Not a conversion of the fresh process the monitor started.
+                reason = 'killed'
+
+            else:
+                instance.record(time.monotonic() - start)
+                reason = instance.worn(
+                    self.max_conversions, self.max_rss, self.max_drift)
+
+            if reason:
+                threading.Thread(
+                    target=self._recycle, args=(instance, reason),
+                    daemon=True).start()
+
+            else:
+                self.idle.put(instance)
+
+    def _start(self, instance):
+        try:
+            while instance.p is None:
+                time.sleep(0.1)
+            self.warm(instance)
+
+        except Exception as e:
+            LOGGER.exception(e)
+
+        finally:
+            with self.lock:
+                self.starting -= 1
+            self.idle.put(instance)
+
+    def _recycle(self, instance, reason):
+        LOGGER.info('Recycling soffice %i: %s', instance.index, reason)
+        metrics.SOFFICE_RECYCLES.inc(instance=instance.index, reason=reason)
+
+        try:
+            if reason == 'killed':
+                # Already restarting, wait for the new process.
+                while instance.p is None or instance.killed.is_set():
+                    time.sleep(0.1)
+
+            else:
+                instance.restart()
+
+            if self.warm:
+                self.warm(instance)
+
+        except Exception as e:
+            # The next conversion on this instance tries again.
+            LOGGER.exception(e)
+
+        finally:
+            self.idle.put(instance)
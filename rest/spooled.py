@@ -1,13 +1,197 @@
+import os
 import asyncio
+import logging
 import tempfile
+import threading
+import weakref
 
+from collections import OrderedDict
 from functools import partial
 from aiofiles.base import AiofilesContextManager
 from aiofiles.tempfile import AsyncSpooledTemporaryFile
 
+import metrics
+
+from config import MAX_MEMORY, MEMORY_BUDGET, STREAM_QUEUE, TEMP_DIR
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class MemoryBudget(object):
+    """
+    Bytes of spooled input and output held in memory, shared by all requests.
+
+    Spools reserve memory as they grow and move to disk when a reservation is
+    refused. Complete input spools waiting for their conversion are parked,
+    once usage passes HIGH of the limit a background thread moves parked
+    spools to disk, newest first (they will wait the longest), until usage is
+    below LOW.
+    """
+    HIGH = 0.9
+    LOW = 0.75
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.parked = OrderedDict()
+        self.lock = threading.Lock()
+        self.relieving = False
+
+    @property
+    def exhausted(self):
+        return self.limit > 0 and self.used >= self.limit
+
+    def reserve(self, size):
+        """
+        Account for size more bytes in memory, False if they do not fit.
+        """
+        if self.limit <= 0:
+            return True
+
+        with self.lock:
+            granted = self.used + size <= self.limit
+            if granted:
+                self.used += size
+            relieve = self.parked and not self.relieving and \
+                self.used + (0 if granted else size) > self.limit * self.HIGH
+            if relieve:
+                self.relieving = True
+
+        if relieve:
+            threading.Thread(target=self._relieve, daemon=True).start()
+        return granted
+
+    def release(self, size):
+        if size:
+            with self.lock:
+                self.used -= size
+
+    def park(self, spool):
+        with self.lock:
+            self.parked[spool] = None
+
+    def unpark(self, spool):
+        with self.lock:
+            self.parked.pop(spool, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'used': self.used,
+                'parked': sum(spool._reserved for spool in self.parked),
+            }
+
+    def _relieve(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.parked or self.used <= self.limit * self.LOW:
+                        return
+                    spool, _ = self.parked.popitem()
+                spool.spill()
+
+        finally:
+            with self.lock:
+                self.relieving = False
+
+
+BUDGET = MemoryBudget(MEMORY_BUDGET)
+
+metrics.Gauge(
+    'officer_memory_budget_bytes',
+    'Memory budget limit, bytes used and bytes used by queued input.',
+    ('stat',), fn=lambda: {(k,): v for k, v in BUDGET.stats().items()})
+
+
+def _release(reserved):
+    BUDGET.release(reserved[0])
+    reserved[0] = 0
+
+
+def memfd(name='output'):
+    """
+    Create an anonymous in-memory file, or a temporary file where memfd is not
+    supported.
+    """
+    if hasattr(os, 'memfd_create'):
+        return os.fdopen(os.memfd_create(name, os.MFD_CLOEXEC), 'w+b')
+    return tempfile.TemporaryFile(dir=TEMP_DIR)
+
 
 class _NamedSpooledTemporaryFile(tempfile.SpooledTemporaryFile):
-    """Class that ensures a NamedTemporaryFile is used on disk."""
+    """
+    Class that ensures a NamedTemporaryFile is used on disk.
+
+    Memory held is reserved from BUDGET, the file is created on disk if the
+    budget is used up and rolled over when a reservation is refused.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reserved = 0
+        self._idle = False
+        self._lock = threading.Lock()
+        if BUDGET.exhausted:
+            metrics.BUDGET_ROLLOVERS.inc(reason='exhausted')
+            self.rollover()
+
+    def _reserve(self):
+        """
+        Reserve memory for what was written, False if the file should be
+        rolled over.
+        """
+        size = self._file.tell()
+        if self._max_size and size > self._max_size:
+            return False
+
+        if size > self._reserved:
+            if not BUDGET.reserve(size - self._reserved):
+                metrics.BUDGET_ROLLOVERS.inc(reason='exhausted')
+                return False
+            self._reserved = size
+
+        return True
+
+    def _check(self, file):
+        if not self._rolled and not self._reserve():
+            self.rollover()
+
+    def park(self):
+        """
+        Called once complete and queued for conversion, the file may be
+        rolled over in the background until pinned.
+        """
+        with self._lock:
+            if not self._rolled:
+                self._idle = True
+                BUDGET.park(self)
+
+    def pin(self):
+        """
+        Called before the file is read, waits for a rollover in progress.
+        """
+        with self._lock:
+            self._idle = False
+            BUDGET.unpark(self)
+
+    def spill(self):
+        with self._lock:
+            if self._idle and not self.closed:
+                metrics.BUDGET_ROLLOVERS.inc(reason='pressure')
+                self.rollover()
+                self._idle = False
+
+    def close(self):
+        self.pin()
+        super().close()
+        BUDGET.release(self._reserved)
+        self._reserved = 0
+
+    def __exit__(self, exc, value, tb):
+        # SpooledTemporaryFile closes the underlying file directly.
+        self.close()
 
     def rollover(self):
         """Overridden to provide a NamedTemporaryFile."""
@@ -24,6 +208,16 @@ class _NamedSpooledTemporaryFile(tempfile.SpooledTemporaryFile):
         newfile.seek(pos, 0)
 
         self._rolled = True
+        BUDGET.release(self._reserved)
+        self._reserved = 0
+
+
+class _AsyncNamedSpooledTemporaryFile(AsyncSpooledTemporaryFile):
+    async def _check(self):
+        # Writes go straight to the in-memory file, bypassing
+        # _NamedSpooledTemporaryFile._check().
+        if not self._file._rolled and not self._file._reserve():
+            await self.rollover()
 
 
 async def _named_spooled_temporary_file(max_size=0, mode='w+b', buffering=-1,
@@ -42,9 +236,162 @@ async def _named_spooled_temporary_file(max_size=0, mode='w+b', buffering=-1,
     f = await loop.run_in_executor(executor, cb)
 
     # Single interface provided by SpooledTemporaryFile for all modes
-    return AsyncSpooledTemporaryFile(f, loop=loop, executor=executor)
+    return _AsyncNamedSpooledTemporaryFile(f, loop=loop, executor=executor)
 
 
 def NamedSpooledTemporaryFile(*args, **kwargs):
     return AiofilesContextManager(
         _named_spooled_temporary_file(*args, **kwargs))
+
+
+async def copyfileobj(src, dst, length=None, hasher=None):
+    size = 0
+    with metrics.phase('spool'):
+        while True:
+            chunk = await src.read(length)
+            if not chunk:
+                break
+            size += len(chunk)
+            if hasher:
+                hasher.update(chunk)
+            await dst.write(chunk)
+        await dst.flush()
+
+    # An AsyncSpooledTemporaryFile has a SpooledTemporaryFile as it's _file
+    # attribute.
+    rolled = getattr(getattr(dst, '_file', None), '_rolled', None)
+    if rolled is not None:
+        metrics.SPOOLED_BYTES.inc(size, storage='disk' if rolled else 'memory')
+    return size
+
+
+class SpooledOutput(object):
+    """
+    Receives conversion output into an anonymous file.
+
+    Output is written to a memfd and moved to an unlinked file in TEMP_DIR
+    once it exceeds max_memory bytes or the memory budget is used up, the
+    choice follows the bytes actually written. Either way the result can be
+    served with sendfile(). Memory is accounted for until the file is
+    released.
+    """
+    def __init__(self, max_memory=MAX_MEMORY):
+        self.max_memory = max_memory
+        self.size = 0
+        self.closed = False
+        self.reserved = [0]
+        self.rolled = BUDGET.exhausted
+        if self.rolled:
+            metrics.BUDGET_ROLLOVERS.inc(reason='exhausted')
+            self.f = tempfile.TemporaryFile(dir=TEMP_DIR)
+
+        else:
+            self.f = memfd()
+            weakref.finalize(self.f, _release, self.reserved)
+
+    def rollover(self):
+        f = tempfile.TemporaryFile(dir=TEMP_DIR)
+        self.f.flush()
+        offset = 0
+        while offset < self.size:
+            offset += os.sendfile(
+                f.fileno(), self.f.fileno(), offset, self.size - offset)
+        f.seek(self.size)
+        self.f.close()
+        self.f = f
+        self.rolled = True
+        _release(self.reserved)
+        LOGGER.debug('Output exceeded %i bytes, moved to disk', self.max_memory)
+
+    def close_output(self):
+        self.closed = True
+        self.f.flush()
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.f.flush()
+
+    def write(self, data):
+        if self.closed:
+            raise IOError('write to closed stream')
+        try:
+            if not self.rolled:
+                if self.size + len(data) > self.max_memory:
+                    self.rollover()
+
+                elif BUDGET.reserve(len(data)):
+                    self.reserved[0] += len(data)
+
+                else:
+                    metrics.BUDGET_ROLLOVERS.inc(reason='exhausted')
+                    self.rollover()
+            self.f.write(data)
+            self.size += len(data)
+        except Exception as e:
+            LOGGER.exception(e)
+            raise
+
+
+class StreamingOutput(object):
+    """
+    Hands conversion output to the event loop while it is being written.
+
+    Chunks pass through a queue bounded by a semaphore. When the consumer falls
+    behind, the writer blocks in write() rather than output piling up in
+    memory.
+    """
+    EOF = None
+
+    def __init__(self, loop, maxsize=STREAM_QUEUE):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.slots = threading.Semaphore(maxsize)
+        self.maxsize = maxsize
+        self.closed = False
+        self.cancelled = False
+        self.future = None
+
+    def close_output(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, self.EOF)
+
+    def write(self, data):
+        if self.closed:
+            raise IOError('write to closed stream')
+        self.slots.acquire()
+        if self.cancelled:
+            raise IOError('stream consumer went away')
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+
+    def done(self, future):
+        # Called on the loop when the conversion finishes, so a failure before
+        # close_output() does not leave the consumer waiting.
+        self.queue.put_nowait(self.EOF)
+
+    def cancel(self):
+        """
+        Called by the consumer when it will no longer read, unblocks the
+        writer.
+        """
+        self.cancelled = True
+        for i in range(self.maxsize):
+            self.slots.release()
+
+    async def read(self):
+        """
+        Return the next chunk, or b'' at the end of the stream.
+
+        Raises the conversion error if the conversion failed.
+        """
+        chunk = await self.queue.get()
+        if chunk is self.EOF:
+            # Put it back so subsequent reads also see the end.
+            self.queue.put_nowait(self.EOF)
+            await self.future
+            return b''
+
+        self.slots.release()
+        return chunk
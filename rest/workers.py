@@ -0,0 +1,69 @@
+import os
+import sys
+import signal
+import logging
+import threading
+import subprocess
+
+from config import MAX_CONCURRENCY, REGISTRY_SOCKET, WORKERS
+from registry import Registry
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def spawn(index):
+    """
+    Start worker process index, running officer again with OFFICER_WORKER
+    set.
+
+    Workers are started afresh rather than forked, the soffice monitor threads
+    are already running in this process.
+    """
+    env = dict(os.environ, OFFICER_WORKER=str(index),
+               REGISTRY_SOCKET=REGISTRY_SOCKET)
+    p = subprocess.Popen([sys.executable] + sys.argv, env=env)
+    LOGGER.info('Started worker %i: %i', index, p.pid)
+    return p
+
+
+def run(pool):
+    """
+    Serve pool to WORKERS worker processes until terminated, restarting
+    workers that exit.
+    """
+    Registry(pool, REGISTRY_SOCKET, MAX_CONCURRENCY).start()
+    workers = [spawn(i) for i in range(WORKERS)]
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        LOGGER.info('Stopping on signal %i', signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping.wait(1.0):
+        for i, p in enumerate(workers):
+            if p.poll() is not None:
+                LOGGER.warning('Worker %i exited with returncode: %s', i,
+                               p.returncode)
+                workers[i] = spawn(i)
+
+    for p in workers:
+        p.terminate()
+    for p in workers:
+        try:
+            p.wait(10)
+
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+    # The monitor threads would restart soffice, so exit without waiting for
+    # them.
+    for instance in pool.instances:
+        if instance.p is not None:
+            instance.p.kill()
+    logging.shutdown()
+    os._exit(0)